@@ -11,9 +11,8 @@ from flask import (
     Response,
     jsonify,
 )
-import os, time
+import os, time, json
 import re
-import natsort
 from urllib.parse import unquote, quote
 import posixpath
 from math import ceil, floor
@@ -35,6 +34,16 @@ parser.add_argument(
 
 parser.add_argument("--skip-scan", action="store_true", help="Skip startup scan.")
 parser.add_argument("--update-daemon", action="store_true", help="Regularly update.")
+parser.add_argument(
+    "--full-scan",
+    action="store_true",
+    help="Ignore the scan manifest and check every file on startup scan.",
+)
+parser.add_argument(
+    "--backfill-thumbs",
+    action="store_true",
+    help="Create missing thumbnails of all media in the background.",
+)
 
 args, unknown = parser.parse_known_args()
 args.debug = bool(args.debug)
@@ -43,6 +52,7 @@ if args.debug:
     logger.VERBOSE_LEVEL = 1
     logger.log("Debug mode enabled.", verbose=1)
 args.skip_scan = bool(args.skip_scan)
+backend.full_scan_mode = bool(args.full_scan)
 
 # temporarily enable debug mode
 # args.debug = True
@@ -106,10 +116,9 @@ def _avatar(type, name):
         user.load_from_db(db)
         avatar_url = user.avatar
         if (not user.avatar) or (not avatar_url.startswith("http")) or user.flagged:
-            if os.path.exists(f"tmp/.cached/{name}.gif"):
-                return set_cache_header(
-                    send_file(f"tmp/.cached/{name}.gif", mimetype="image/gif")
-                )
+            cached_avatar = utils.proxy_cache.get(f"{name}.gif")
+            if cached_avatar:
+                return set_cache_header(send_file(cached_avatar, mimetype="image/gif"))
             if user.flagged:
                 logger.log(name, "is flagged, skip avatar downloading.")
             if os.path.exists(fn_bck):
@@ -233,6 +242,9 @@ def _userlist():
         query = request.args["q"]
     else:
         query = ""
+    sort_ = request.args.get("sort", "updated")
+    if sort_ != "updated" and sort_ not in backend.user_sorts:
+        return "Invalid sort type."
     if query:
         fuzz_query = (
             query.replace("https://", "")
@@ -244,30 +256,47 @@ def _userlist():
             .replace("furaffinity.net/user/", "")
             .lower()
         )
-        all_users = [
-            u
-            for u in backend.all_users
-            if fuzz_query in u.nick.lower()
-            or fuzz_query in u.uid.lower()
-            or fuzz_query in u.user_name.lower()
-            or fuzz_query in u.description.lower()
-        ]
+        all_users = backend.user_index.search(fuzz_query)
+        if sort_ != "updated":
+            matched = set(u.uid for u in all_users)
+            all_users = backend.user_index.get(
+                uid
+                for uid in backend.sorted_user_ids(db, sort_)
+                if uid in matched
+            )
         users = all_users[
             page * config.items_per_page : (page + 1) * config.items_per_page
         ]
         max_page = ceil(len(all_users) / config.items_per_page)
+    elif sort_ != "updated":
+        users = backend.user_index.get(
+            backend.sorted_user_ids(db, sort_)[
+                page * config.items_per_page : (page + 1) * config.items_per_page
+            ]
+        )
+        max_page = ceil(len(backend.user_index) / config.items_per_page)
     else:
-        users = backend.all_users[
-            page * config.items_per_page : (page + 1) * config.items_per_page
-        ]
-        max_page = ceil(len(backend.all_users) / config.items_per_page)
+        users = backend.user_index.page(
+            page * config.items_per_page, (page + 1) * config.items_per_page
+        )
+        max_page = ceil(len(backend.user_index) / config.items_per_page)
+    backend.load_user_stats(db, users)
+    page_url = posixpath.join("/", config.url_base, "userlist")
     seach_bar = render_template("searchbar.html", url_base=config.url_base)
-    userlist = render_template("userlist.html", users=users, url_base=config.url_base)
+    userlist = render_template(
+        "userlist.html",
+        users=users,
+        url_base=config.url_base,
+        page_url=page_url,
+        sort_type=sort_,
+        sorts=("updated",) + tuple(backend.user_sorts),
+        current_q=query,
+    )
     return render_template(
         "nav.html",
         current_page=page + 1,
         current_q=query,
-        current_url=posixpath.join("/", config.url_base, "userlist"),
+        current_url=page_url + ("" if sort_ == "updated" else f"?sort={sort_}"),
         max_page=max_page,
         content=seach_bar + userlist,
         section="users",
@@ -306,17 +335,19 @@ def get_posts(method="tl", query="", sort_="new", page=0, user_name="", type_=""
             ]
             sorted_posts_id = [i[0] for i in sorted_posts_id][::-1]
         else:
-            all_post_count = len(backend.cache_all_posts_id)
+            # one snapshot for the whole request, it may be swapped meanwhile
+            timeline = backend.timeline
+            all_post_count = len(timeline.post_ids)
             if sort_ == "new":
-                sorted_posts_id = backend.cache_all_posts_id[
+                sorted_posts_id = timeline.posts[
                     page * config.items_per_page : (page + 1) * config.items_per_page
                 ]
             elif sort_ == "top":
-                sorted_posts_id = backend.cache_all_posts_id_top[
+                sorted_posts_id = timeline.posts_top[
                     page * config.items_per_page : (page + 1) * config.items_per_page
                 ]
             elif sort_ == "random":
-                sorted_posts_id = backend.cache_all_posts_id_random[
+                sorted_posts_id = timeline.posts_random[
                     page * config.items_per_page : (page + 1) * config.items_per_page
                 ]
             else:
@@ -325,27 +356,17 @@ def get_posts(method="tl", query="", sort_="new", page=0, user_name="", type_=""
         return sorted_posts_id, all_post_count
 
     elif method == "fav":
-        sorted_posts_id = backend.get_fav(db)
-        all_post_count = len(sorted_posts_id)
-        sorted_posts_id = [i[0] for i in sorted_posts_id if i[0]][::-1]
-        sorted_posts_id = sorted_posts_id[
-            page * config.items_per_page : (page + 1) * config.items_per_page
-        ][::-1]
+        all_post_count = backend.count_fav(db)
+        sorted_posts_id = backend.get_fav_page(db, page, config.items_per_page)[::-1]
         return sorted_posts_id, all_post_count
 
     elif method == "user":
         if not user_name or not type_:
             return [], 0
         uid = f"{user_name}@{type_}"
-        all_rows = db.query_rows(
-            selected_db="posts", key="uid", value=uid, sort_key=lambda x: x[4]
-        )
-        all_post_count = len(all_rows)
+        all_post_count = db.get_user_stats(uid)[0]
         sorted_posts_id = [
-            row[0]
-            for row in all_rows[
-                page * config.items_per_page : (page + 1) * config.items_per_page
-            ]
+            row[1] for row in db.query_page("posts", uid, page, config.items_per_page)
         ][::-1]
         return sorted_posts_id, all_post_count
 
@@ -361,9 +382,6 @@ def _timeline(method="tl", type_="", user_name=""):
     """
     global tl_current_sort, tl_current_page
 
-    if utils.busy_flag:
-        return render_template("busy.html", url_base=config.url_base)
-
     # Parse common request args
     if "p" in request.args:
         page = int(request.args["p"]) - 1
@@ -403,6 +421,8 @@ def _timeline(method="tl", type_="", user_name=""):
         user_obj.load_from_db(db)
         if not user_obj.url:
             user_obj.concat_url()
+        user_obj.load_stats(db.get_user_stats(f"{user_name}@{type_}"))
+        utils.thumbnail_worker.touch(f"{user_name}@{type_}")
 
     # Get posts based on method
     if method == "tl":
@@ -426,37 +446,22 @@ def _timeline(method="tl", type_="", user_name=""):
     # Handle media tab for fav and user methods
     if tab == "media" and method in ("fav", "user"):
         # Re-fetch with adjusted pagination for media tab
-        if method == "fav":
-            fav_posts = backend.get_fav(db)
-            all_post_count = len(fav_posts)
-            fav_post_ids = [i[0] for i in fav_posts if i[0]][::-1]
-            sorted_posts_id = fav_post_ids[
-                page
-                * config.items_per_page
-                * 2 : (page + 1)
-                * config.items_per_page
-                * 2
-            ]
-        elif method == "user":
+        if method == "user":
             uid = f"{user_name}@{type_}"
-            all_rows = db.query_rows(
-                selected_db="media", key="uid", value=uid, sort_key=lambda x: x[5]
-            )
-            all_post_count = len(all_rows)
+            all_post_count = user_obj.media_count
+            page_media_id = [
+                row[1]
+                for row in db.query_page("media", uid, page, config.items_per_page * 2)
+            ]
+            rows = {row[0]: row for row in db.query_in("media", "media_id", page_media_id)}
 
             media_entries = dict()
             sorted_media_id = []
-            for row in all_rows[
-                page
-                * config.items_per_page
-                * 2 : (page + 1)
-                * config.items_per_page
-                * 2
-            ]:
-                media_id = row[0]
+            for media_id in page_media_id:
+                row = rows[media_id]
                 post_id = row[1]
                 media = backend.Media(media_id, post_id, user_name, type_, "")
-                media.load_from_db(db)
+                media.load_from_row(row)
                 media_entries[media_id] = media
                 sorted_media_id.append(media_id)
 
@@ -479,7 +484,6 @@ def _timeline(method="tl", type_="", user_name=""):
                 type=type_,
                 user=user_obj,
                 url_base=config.url_base,
-                posts_cnt=all_post_count,
             )
             return render_template(
                 "nav.html",
@@ -503,28 +507,15 @@ def _timeline(method="tl", type_="", user_name=""):
 
         # Handle media tab for fav
         if method == "fav":
+            # paginated by media, favorites of missing posts are left out
+            all_post_count = backend.count_fav_media(db)
             media_entries = dict()
-            users = dict()
             sorted_media_id = []
-            for post_id in sorted_posts_id:
-                if post_id in ("redgifs",):
-                    continue
-                post = backend.Post(post_id, None, None)
-                if not post.load_from_db(db):
-                    logger.log(f"Post [{post_id}] not found.")
-                    continue
-                for row in db.query_rows(
-                    selected_db="media", key="post_id", value=post_id
-                ):
-                    media_id = row[0]
-                    sorted_media_id.append(media_id)
-                    media = backend.Media(media_id, post_id, None, post.type, post.time)
-                    media.load_from_db(db)
-                    media_entries[media_id] = media
-                if post.user_name not in users:
-                    user = backend.User(post.user_name, post.type)
-                    user.load_from_db(db)
-                    users[post.user_name] = user
+            for row in backend.get_fav_media_page(db, page, config.items_per_page * 2):
+                media = backend.Media(row[0], row[1], None, None, row[5])
+                media.load_from_row(row)
+                sorted_media_id.append(media.media_id)
+                media_entries[media.media_id] = media
 
             timeline_content = render_template(
                 "mediagrid.html",
@@ -534,7 +525,7 @@ def _timeline(method="tl", type_="", user_name=""):
                 items_per_page=config.items_per_page * 2,
                 user_name="",
                 type=type,
-                users=users,
+                users=dict(),
                 url_base=config.url_base,
                 page_url=f"{config.url_base}/fav",
             )
@@ -551,109 +542,60 @@ def _timeline(method="tl", type_="", user_name=""):
                 adjust_padding_top=True,
             )
 
-    # Load posts and media for posts tab
-    posts = dict()
+    # Each post is shown below the posts it replies to, thread root first.
+    # sorted_posts_id is oldest first at this point, the page newest first.
+    chains = db.query_reply_chains(sorted_posts_id)
     external_posts = dict()
-    media_entries = dict()
-    users = dict()
-    existing_sorted_posts_id = []
-
-    cnt = 0
-    while cnt < len(sorted_posts_id):
-        if len(sorted_posts_id) > config.items_per_page * 5:
-            logger.log(
-                f"Warning: Large number of posts to load: {len(sorted_posts_id)}",
-                type="warning",
-            )
-        if len(sorted_posts_id) > config.items_per_page * 10:
-            logger.log(
-                f"Error: Too many posts to load: {len(sorted_posts_id)}, there might be a loop in replies. Stopping further loading.",
-                type="error",
-            )
-            break
-        post_id = sorted_posts_id[cnt]
-        cnt += 1
-        if post_id in posts:
-            post = posts[post_id]
-            existing_sorted_posts_id.append(post_id)
-            # load reply info here, so that replies of duplicate posts are also handled
-            if post.isreply and post.reply_to and method != "fav":
-                reply_post_id, reply_user_name = post.reply_to.split("@")
-                sorted_posts_id.insert(cnt, reply_post_id)
-                external_posts[reply_post_id] = (post.type, reply_user_name)
-            continue
-        if post_id in ("redgifs",):
-            continue
+    thread_posts_id = []
+    for post_id in sorted_posts_id[::-1]:
+        for reply_post_id, reply_user_name, reply_type in chains.get(post_id, [])[
+            ::-1
+        ]:
+            thread_posts_id.append(reply_post_id)
+            external_posts[reply_post_id] = (reply_type, reply_user_name)
+        thread_posts_id.append(post_id)
+    # Remove duplicates while preserving order
+    sorted_posts_id = list(dict.fromkeys(thread_posts_id))
 
+    # Load posts and media for posts tab
+    posts, media_entries, users = backend.hydrate_posts(
+        db, [i for i in sorted_posts_id if i not in ("redgifs",)]
+    )
+    # users of posts missing from the database
+    missing_users = dict()
+    for post_id in sorted_posts_id:
+        if post_id in posts or post_id in ("redgifs",):
+            continue
         post = backend.Post(post_id, None, None)
-        if not post.load_from_db(db):
-            if method == "tl" or method == "user":
-                post.isplaceholder = True
-                post.type, post.user_name = external_posts.get(post_id, ("", ""))
-                post.concat_url()
-                print("guessed url for external post:", post.url)
-            elif method == "fav":
-                logger.log(f"Post [{post_id}] not found.")
-                post.user_name = "None"
-                post.text_content = (
-                    f"This post is missing from file system. [{post_id}]"
-                )
-                post.fav = True
-            else:
-                post.user_name = "None"
-                post.text_content = f"HOW DID YOU EVEN GET HERE? [{post_id}]"
-
-        # Load reply info
-        if post.isreply and post.reply_to:
-            print("post", post.post_id, "is a reply to", post.reply_to)
-            reply_post_id, reply_user_name = post.reply_to.split("@")
-            sorted_posts_id.insert(cnt, reply_post_id)
-            external_posts[reply_post_id] = (post.type, reply_user_name)
-
-        post.init_embed(db)
+        if method == "tl" or method == "user":
+            post.isplaceholder = True
+            post.type, post.user_name = external_posts.get(post_id, ("", ""))
+            post.concat_url()
+        elif method == "fav":
+            logger.log(f"Post [{post_id}] not found.")
+            post.user_name = "None"
+            post.text_content = f"This post is missing from file system. [{post_id}]"
+            post.fav = True
+        else:
+            post.user_name = "None"
+            post.text_content = f"HOW DID YOU EVEN GET HERE? [{post_id}]"
         posts[post_id] = post
-        existing_sorted_posts_id.append(post_id)
-
-        # Load media for post
-        for row in db.query_rows(selected_db="media", key="post_id", value=post_id):
-            media_id = row[0]
-            media = backend.Media(
-                media_id, post_id, post.user_name, post.type, post.time
-            )
-            media.load_from_db(db)
-            if post_id not in media_entries:
-                media_entries[post_id] = [media]
-            else:
-                media_entries[post_id].append(media)
-
-        if post_id in media_entries and len(media_entries[post_id]) > 1:
-            media_entries[post_id] = natsort.natsorted(
-                media_entries[post_id], key=lambda x: x.media_id
-            )
-
-        # Load user info
         if post.user_name not in users:
-            user = backend.User(post.user_name, post.type)
-            user.load_from_db(db)
-            if method == "fav" and post.user_name == "None":
-                user.nick = "None"
-            users[post.user_name] = user
+            missing_users[post.user_name] = post.type
+
+    found = backend.hydrate_users(
+        db, [f"{name}@{t}" for name, t in missing_users.items() if name and t]
+    )
+    for name, t in missing_users.items():
+        user = found.get(f"{name}@{t}") or backend.User(name, t)
+        if method == "fav" and name == "None":
+            user.nick = "None"
+        users[name] = user
 
     # For user method, ensure user is in users dict
     if method == "user" and user_name not in users:
         users[user_name] = user_obj
 
-    sorted_posts_id = sorted_posts_id[::-1]
-
-    # Remove duplicates while preserving order
-    seen = set()
-    unique_sorted_posts_id = []
-    for post_id in sorted_posts_id:
-        if post_id not in seen:
-            seen.add(post_id)
-            unique_sorted_posts_id.append(post_id)
-    sorted_posts_id = unique_sorted_posts_id
-
     # Determine page URL and rendering options
     if method == "tl":
         page_url = f"{config.url_base}/tl"
@@ -715,7 +657,6 @@ def _timeline(method="tl", type_="", user_name=""):
             type=type_,
             user=user_obj,
             url_base=config.url_base,
-            posts_cnt=all_post_count,
         )
         content = userheader + timeline_content
         current_url = (
@@ -856,13 +797,21 @@ def _thumb(type, name, fn):
     size = config.thubnail_size
     if "size" in request.args:
         size = int(request.args["size"])
-        size = min(max(size, 32), 2500)
+        size = utils.snap_thumbnail_size(size)
     path = f"{config.fs_bases[type]}/{name}/{fn}"
-    thumbnail_path = utils.create_thumbnail(path, size)
+    utils.thumbnail_worker.touch(f"{name.lower()}@{type}")
+    # only formats named in Accept count, every client accepts */*
+    fmt = utils.pick_thumbnail_format(
+        {mimetype for mimetype, q in request.accept_mimetypes if q > 0}
+    )
+    thumbnail_path = utils.create_thumbnail(path, size, fmt)
     if not thumbnail_path or not os.path.exists(thumbnail_path):
         logger.log(f"Thumbnail not found for {path}.")
-        return set_cache_header(send_file("img/error.jpg", mimetype="image/jpeg"))
-    return set_cache_header(send_file(thumbnail_path, mimetype="image/jpeg"))
+        response = send_file("img/error.jpg", mimetype="image/jpeg")
+    else:
+        response = send_file(thumbnail_path, mimetype=utils.thumbnail_formats[fmt][1])
+    response.headers["Vary"] = "Accept"
+    return set_cache_header(response)
 
 
 @app.route(posixpath.join("/", config.url_base, "view", "<type>", "<name>", "<fn>"))
@@ -872,7 +821,7 @@ def _view(type, name, fn):
         type=type,
         user_name=name,
         file_name=fn,
-        isvideo=fn.endswith(".mp4") or fn.endswith(".webm"),
+        isvideo=backend.media_kind(fn) == "video",
         url_base=config.url_base,
     )
 
@@ -940,31 +889,12 @@ def _api_interrupt():
 
 @app.route(posixpath.join("/", config.url_base, "shorts"), methods=["GET"])
 def _shorts():
-    if utils.busy_flag:
-        return render_template("busy.html", url_base=config.url_base)
     type = request.args.get("type", "")
     user_name = request.args.get("user", "")
     uid = f"{user_name}@{type}"
     query = request.args.get("q", "")
     if user_name:
-        if not uid in backend.cache_user_media_id:
-            logger.log(f"cache miss for {user_name}, building cache...")
-            # Need to find media for this user across all sources
-            media_ids = db.raw_query(
-                f"SELECT media_id, time, file_name FROM media WHERE uid = '{user_name}@{type}'"
-            )
-            media_ids = [
-                (i[0], i[1])
-                for i in media_ids
-                if i[2].split(".")[-1] in backend.valid_video_types
-            ]
-            if len(media_ids) > 0:
-                media_ids = sorted(media_ids, key=lambda s: s[1], reverse=True)
-                media_ids = [i[0] for i in media_ids]
-                backend.cache_user_media_id[uid] = media_ids
-            total_cnt = len(media_ids)
-        else:
-            total_cnt = len(backend.cache_user_media_id[uid])
+        total_cnt = len(backend.get_user_videos(db, uid))
         return render_template(
             "shorts.html",
             url_base=config.url_base,
@@ -988,7 +918,7 @@ def _shorts():
         )
     else:
         user_name = ""
-        idx = randint(0, len(backend.cache_all_media_id))
+        idx = randint(0, len(backend.timeline.video_ids))
         return render_template(
             "shorts.html",
             url_base=config.url_base,
@@ -1000,68 +930,25 @@ def _shorts():
         )
 
 
-@app.route(posixpath.join("/", config.url_base, "get-a-vid"), methods=["GET"])
-def _get_a_vid():
-    user_name = request.args.get("user", "")
-    type = request.args.get("type", "")
-    uid = f"{user_name}@{type}"
-    idx = int(request.args.get("idx", 0))
-    query = request.args.get("q", "").strip()
+def shorts_videos(user_name, type, query):
+    """Media IDs the shorts player steps through by index."""
     if user_name:
-        # get a media_id from user by order
-        if not uid in backend.cache_user_media_id:
-            logger.log(f"[shorts] Cache miss for {user_name}, building cache...")
-            # Need to find the uid for this user - try to get type from most recent media
-            media_rows = db.raw_query(
-                f"SELECT media_id, time, file_name, type FROM media WHERE uid = '{uid}'"
-            )
-            if not media_rows:
-                return {
-                    "error": f"No media found for user {user_name}.",
-                }
-            media_ids = [
-                (i[0], i[1])
-                for i in media_rows
-                if i[2].split(".")[-1] in backend.valid_video_types
-            ]
-            if len(media_ids) > 0:
-                media_ids = sorted(media_ids, key=lambda s: s[1], reverse=True)
-                media_ids = [i[0] for i in media_ids]
-                backend.cache_user_media_id[uid] = media_ids
-            if not media_ids:
-                return {
-                    "error": f"No video found for user {uid}.",
-                }
-            backend.cache_user_media_id[uid] = media_ids
-        else:
-            logger.log(f"[shorts] Cache hit for {uid}", verbose=2)
-            media_ids = backend.cache_user_media_id[uid]
-        idx = idx % len(media_ids)
-        media_id = media_ids[idx]
+        return backend.get_user_videos(db, f"{user_name}@{type}")
     elif query:
-        media_ids = db.query_media_by_text(query)
-        idx = idx % len(media_ids)
-        media_id = media_ids[idx]
-    else:
-        if len(backend.cache_all_media_id) == 0:
-            return {
-                "error": f"No video found.",
-            }
-        media_id = backend.cache_all_media_id[idx % len(backend.cache_all_media_id)]
-    media = backend.Media(media_id, None, None, "", "")
-    media.load_from_db(db)
-    post = backend.Post(media.post_id, None, None)
-    post.load_from_db(db)
-    user = backend.User(post.user_name, post.type)
-    user.load_from_db(db)
-    data = {
+        return db.query_media_by_text(query)
+    return backend.timeline.videos
+
+
+def video_descriptor(media_id, file_name, post, author):
+    """What the shorts player needs to show one video."""
+    return {
         "url": posixpath.join(
-            "/", config.url_base, "file", post.type, post.user_name, media.file_name
+            "/", config.url_base, "file", post.type, post.user_name, file_name
         ),
         "preview": posixpath.join(
-            "/", config.url_base, "thumb", post.type, post.user_name, media.file_name
+            "/", config.url_base, "thumb", post.type, post.user_name, file_name
         ),
-        "author": user.nick,
+        "author": author,
         "author_id": post.real_user if post.real_user else post.user_name,
         "avatar": f"{config.url_base}/avatar/{post.type}/{post.user_name}",
         "likes": post.likes,
@@ -1069,44 +956,97 @@ def _get_a_vid():
         "reposts": post.reposts,
         "description": post.text_content,
         "post_id": post.post_id,
-        "media_id": media.media_id,
-        "fav": bool(
-            db.query_rows(selected_db="fav", key="post_id", value=post.post_id)
-        ),
+        "media_id": media_id,
+        "fav": post.fav,
         "post_url": post.url,
         "user_url": f"{config.url_base}/user/{post.type}/{post.user_name}",
         "time": post.time,
         "type": post.type,
     }
+
+
+@app.route(posixpath.join("/", config.url_base, "get-a-vid"), methods=["GET"])
+def _get_a_vid():
+    user_name = request.args.get("user", "")
+    type = request.args.get("type", "")
+    uid = f"{user_name}@{type}"
+    idx = int(request.args.get("idx", 0))
+    query = request.args.get("q", "").strip()
+    media_ids = shorts_videos(user_name, type, query)
+    if not media_ids:
+        if user_name:
+            return {
+                "error": f"No video found for user {uid}.",
+            }
+        return {
+            "error": f"No video found.",
+        }
+    media_id = media_ids[idx % len(media_ids)]
+    videos = backend.hydrate_videos(db, [media_id])
+    if media_id not in videos:
+        return {
+            "error": f"Post of video {media_id} not found.",
+        }
+    return jsonify(video_descriptor(media_id, *videos[media_id]))
+
+
+@app.route(posixpath.join("/", config.url_base, "get-vids"), methods=["GET"])
+def _get_vids():
+    """
+    A batch of videos for the shorts player to queue up, starting at index
+    start and wrapping around like /get-a-vid. Each descriptor carries its idx.
+    """
+    user_name = request.args.get("user", "")
+    type = request.args.get("type", "")
+    start = int(request.args.get("start", 0))
+    count = min(max(int(request.args.get("count", 10)), 1), 50)
+    query = request.args.get("q", "").strip()
+    media_ids = shorts_videos(user_name, type, query)
+    if not media_ids:
+        return {
+            "error": f"No video found.",
+        }
+    indexes = [(start + i) % len(media_ids) for i in range(count)]
+    videos = backend.hydrate_videos(db, [media_ids[i] for i in indexes])
+    data = []
+    for i in indexes:
+        media_id = media_ids[i]
+        if media_id in videos:
+            descriptor = video_descriptor(media_id, *videos[media_id])
+            descriptor["idx"] = i
+            data.append(descriptor)
     return jsonify(data)
 
 
 @app.route(posixpath.join("/", config.url_base, "api", "favs"))
 def _api_favs():
-    favs = backend.get_fav(db)
-    fav_files = []
-    for fav in favs:
-        post_id = fav[0]
-        fav_time = fav[1]  # Wed Jun  4 19:01:32 2025
-        # to timestamp
-        fav_time = time.mktime(time.strptime(fav_time, "%a %b %d %H:%M:%S %Y"))
-        post = backend.Post(post_id, None, None)
-        if not post.load_from_db(db):
-            logger.log(f"Post [{post_id}] not found.")
-            continue
-        for row in db.query_rows(selected_db="media", key="post_id", value=post_id):
-            media_id = row[0]
-            media = backend.Media(media_id, post_id, None, post.type, post.time)
-            media.load_from_db(db)
-            fav_files.append(
-                (
-                    os.path.join(
-                        config.fs_bases[post.type], post.user_name, media.file_name
-                    ),
-                    fav_time,
-                )
-            )
-    return jsonify(fav_files)
+    """
+    [path, fav time] of every favorited file, streamed as a JSON array, or
+    as one JSON array per line with format=ndjson.
+    since: only favorites added after this epoch time, for incremental syncs
+    """
+    since = request.args.get("since", None)
+    try:
+        since = float(since) if since else None
+    except ValueError:
+        return "Invalid since time."
+    ndjson = request.args.get("format", "") == "ndjson"
+    files = backend.iter_fav_files(db, since)
+
+    def generate():
+        if ndjson:
+            for item in files:
+                yield json.dumps(item, separators=(",", ":")) + "\n"
+            return
+        yield "["
+        for i, item in enumerate(files):
+            yield ("," if i else "") + json.dumps(item, separators=(",", ":"))
+        yield "]\n"
+
+    return Response(
+        generate(),
+        mimetype="application/x-ndjson" if ndjson else "application/json",
+    )
 
 
 @app.route(posixpath.join("/", config.url_base, "logs"))
@@ -1127,16 +1067,20 @@ def cache_proxy(subpath):
     subpath.lstrip("/")
     subpath = "https://" + subpath
     filename = subpath.split("/")[-1]
-    cache_path = os.path.join("tmp/.cached", filename)
-    if os.path.exists(cache_path):
+    cache_path = utils.proxy_cache.get(filename)
+    if cache_path:
         logger.log(f"Serving from cache: {cache_path}", verbose=1)
         return set_cache_header(send_file(cache_path))
     else:
-        os.makedirs("tmp/.cached", exist_ok=True)
+        cache_path = utils.proxy_cache.path(filename)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
         logger.log(f"Fetching from remote: {subpath}")
         r = requests.get(subpath, headers=utils.headers)
-        with open(cache_path, "wb") as f:
+        temp_path = utils.get_temp_path(cache_path)
+        with open(temp_path, "wb") as f:
             f.write(r.content)
+        os.replace(temp_path, cache_path)
+        utils.proxy_cache.touch(filename)
         logger.log(f"Cached to: {cache_path}")
         return set_cache_header(send_file(cache_path))
 
@@ -1145,44 +1089,80 @@ def build_cache_all_posts_id_thread(db):
     while True:
         try:
             if utils.has_new_download:
-                utils.busy_flag = True
+                # cleared first, so a download finishing during the build
+                # triggers the next one
+                utils.has_new_download = False
                 logger.log("Building cache...")
                 backend.build_cache(db)
                 logger.log("Cache built.")
-                utils.has_new_download = False
-                utils.busy_flag = False
+                logger.log("Query cache:", backend.query_cache.stats())
             else:
                 logger.log("No new download, skipping cache build.")
         except Exception as e:
             logger.log(traceback.format_exc(), type="error")
-            utils.busy_flag = False
         # Sleep for a while to avoid busy looping
         time.sleep(60 * 60)
 
 
 def init(db, skip_scan):
+    """
+    Load users and the saved timeline, then scan posts and media in the
+    background. Pages are served from the saved timeline until the scan is
+    done and build_cache() has caught up.
+    :return: the startup scan thread
+    """
+    # forked before any thread is started, shut down after the startup scan
+    ingest_pool = None if skip_scan else backend.start_ingest_pool()
+    start_workers(db)
+    backend.load_saved_timeline(db)
     backend.scan_for_users("x", db)
     backend.scan_for_users("bsky", db)
     backend.scan_for_users("reddit", db)
     backend.scan_for_users("fa", db)
+    scan_thread = Thread(
+        target=startup_scan, args=(db, skip_scan, ingest_pool), daemon=True
+    )
+    scan_thread.start()
+
+    if args.update_daemon:
+        logger.log("Starting update daemon...")
+        Thread(target=utils.update_daemon, daemon=True).start()
+    return scan_thread
+
+
+def start_workers(db):
+    worker = utils.DownloadWorker(db)
+    worker.setDaemon(True)
+    worker.start()
+    logger.log("Download worker started.")
+    utils.thumbnail_worker = utils.ThumbnailWorker()
+    utils.thumbnail_worker.start()
+    utils.thumbnail_cache.start()
+    utils.proxy_cache.start()
+
+
+def startup_scan(db, skip_scan, ingest_pool=None):
     if not skip_scan:
-        backend.scan_for_posts("x", db)
+        backend.scan_for_posts("x", db, pool=ingest_pool)
         backend.scan_for_media("x", db)
-        backend.scan_for_posts("bsky", db)
+        backend.scan_for_posts("bsky", db, pool=ingest_pool)
         backend.scan_for_media("bsky", db)
-        backend.scan_for_posts("reddit", db)
+        backend.scan_for_posts("reddit", db, pool=ingest_pool)
         backend.scan_for_media("reddit", db)
-        backend.scan_for_posts("fa", db)
+        backend.scan_for_posts("fa", db, pool=ingest_pool)
         backend.scan_for_media("fa", db)
+    if ingest_pool:
+        ingest_pool.shutdown()
     db.commit()
+    db.analyze()
     logger.log("Scan finished.")
 
     Thread(target=build_cache_all_posts_id_thread, args=(db,), daemon=True).start()
     logger.log("Cache building thread started.")
-
-    if args.update_daemon:
-        logger.log("Starting update daemon...")
-        Thread(target=utils.update_daemon, daemon=True).start()
+    Thread(target=backend.rerender_html, args=(db,), daemon=True).start()
+    Thread(target=backend.backfill_media_bytes, args=(db,), daemon=True).start()
+    if args.backfill_thumbs:
+        Thread(target=utils.thumbnail_worker.backfill, args=(db,), daemon=True).start()
 
 
 def shutdown_cleanup():
@@ -1203,10 +1183,6 @@ def wsgi_app(skip_scan=False):
 db = backend.Database("data.db", "fav.db")
 db.prepare_db()
 utils.global_running_flag = True
-worker = utils.DownloadWorker(db)
-worker.setDaemon(True)
-worker.start()
-logger.log("Download worker started.")
 logger.log("Ready.")
 
 if __name__ == "__main__":
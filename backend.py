@@ -2,19 +2,493 @@ import sqlite3
 import os, json, re, time, sys
 import natsort, random
 import threading
+import bisect
+import traceback
+import multiprocessing
+import mmap
+import struct
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 import config, utils, logger
+from db_sql import user_stats_sql, all_user_stats_sql, bump_generation_sql
 
 debug_mode = False
+# below this many files per user directory, parsing in the process pool costs more than it saves
+parallel_parse_min_files = 256
+# ignore the scan manifest and re-check every file on full scans
+full_scan_mode = False
+# sqlite allows 32766 bound variables, keep IN (...) lists well below that
+in_query_chunk_size = 500
+
+
+class LRUCache:
+    """
+    LRU cache bounded by entry count and estimated size in bytes.
+    Entries carry tags, e.g. the tables a query read, so that a write only
+    invalidates the entries that depend on what it touched.
+    """
+
+    def __init__(self, max_entries, max_bytes=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, size, tags)
+        self.tagged = dict()  # tag -> set of keys
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bumped by every invalidation, see put()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+    def put(self, key, value, tags=(), size=None, generation=None):
+        """
+        :param generation: self.generation from before the value was read,
+            the value is dropped if an invalidation happened in between
+        """
+        if size is None:
+            size = estimate_size(value)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, tags)
+            self.bytes += size
+            for tag in tags:
+                self.tagged.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries or (
+                self.max_bytes and self.bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, tags):
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                for key in self.tagged.pop(tag, ()):
+                    if key in self.entries:
+                        self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries = OrderedDict()
+            self.tagged = dict()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, key):
+        _, size, tags = self.entries.pop(key)
+        self.bytes -= size
+        for tag in tags:
+            keys = self.tagged.get(tag)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self.tagged[tag]
+
+
+def estimate_size(value):
+    """Rough size in bytes of a query result, sampled for long lists."""
+    if not isinstance(value, (list, tuple)):
+        return sys.getsizeof(value)
+    size = sys.getsizeof(value)
+    sample = value[:20]
+    if sample:
+        sample_size = sum(estimate_size(x) for x in sample)
+        size += sample_size * len(value) // len(sample)
+    return size
+
+
+table_pattern = re.compile(r"\b(?:FROM|JOIN)\s+([\w.]+)", re.IGNORECASE)
+
+
+def query_tables(sql):
+    """Names of the tables a query reads, used as its cache tags."""
+    tables = set()
+    for table in table_pattern.findall(sql):
+        table = table.split(".")[-1].lower()
+        # the full text index only changes together with posts
+        if table.endswith("_fts"):
+            table = table[:-4]
+        tables.add(table)
+    return tuple(tables)
+
+
+class IdTable:
+    """
+    Append-only table of IDs packed into one utf-8 blob, looked up by
+    position. Far smaller than a list of str objects for millions of posts.
+    """
+
+    def __init__(self):
+        self.blob = bytearray()
+        self.offsets = array("Q", [0])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, pos):
+        # blob is a memoryview of the mapped file for loaded snapshots
+        return str(self.blob[self.offsets[pos] : self.offsets[pos + 1]], "utf-8")
+
+    def append(self, id):
+        self.blob += id.encode()
+        self.offsets.append(len(self.blob))
+
+
+class TimelineIndex:
+    """
+    One ordering of the IDs in an IdTable, used in place of the lists of
+    (post_id, ts) tuples the timeline caches used to be. Indexing and
+    slicing return the same tuples, or bare IDs if there are no keys.
+    :param order: array of positions in ids
+    :param keys: array of values by position, e.g. ts or likes
+    """
+
+    def __init__(self, ids: IdTable, order, keys=None):
+        self.ids = ids
+        self.order = order
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        for pos in self.order:
+            yield self.item(pos)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.item(pos) for pos in self.order[i]]
+        return self.item(self.order[i])
+
+    def item(self, pos):
+        if self.keys is None:
+            return self.ids[pos]
+        return self.ids[pos], self.keys[pos]
+
+
+class TimelineSnapshot:
+    """
+    The timeline caches: all posts by time, by likes and shuffled, and all
+    videos shuffled. A published snapshot is never modified, rebuilds and
+    merges work on a new one and swap the module level timeline reference
+    under snapshot_lock, so readers never wait and never see a half-built
+    cache.
+    """
+
+    # every table in the order they are saved, typecode None for an IdTable
+    fields = (
+        ("post_ids", None),
+        ("post_ts", "q"),
+        ("post_likes", "q"),
+        ("by_time", "I"),
+        ("by_likes", "I"),
+        ("post_shuffled", "I"),
+        ("video_ids", None),
+        ("video_ts", "q"),
+        ("video_by_time", "I"),
+        ("video_shuffled", "I"),
+    )
+
+    def __init__(self):
+        # meta generation of the database this was built from, see save_timeline()
+        self.generation = None
+        self.post_ids = IdTable()
+        self.post_ts = array("q")
+        self.post_likes = array("q")
+        self.by_time = array("I")
+        self.by_likes = array("I")
+        self.post_shuffled = array("I")
+        self.video_ids = IdTable()
+        self.video_ts = array("q")
+        self.video_by_time = array("I")
+        self.video_shuffled = array("I")
+
+    @property
+    def posts(self):
+        return TimelineIndex(self.post_ids, self.by_time, self.post_ts)
+
+    @property
+    def posts_top(self):
+        return TimelineIndex(self.post_ids, self.by_likes, self.post_likes)
+
+    @property
+    def posts_random(self):
+        return TimelineIndex(self.post_ids, self.post_shuffled, self.post_ts)
+
+    @property
+    def videos(self):
+        return TimelineIndex(self.video_ids, self.video_shuffled)
+
+    def add_post(self, post_id, ts, likes):
+        self.post_ids.append(post_id)
+        self.post_ts.append(ts or 0)
+        self.post_likes.append(likes or 0)
+
+    def add_video(self, media_id, ts):
+        self.video_ids.append(media_id)
+        self.video_ts.append(ts or 0)
+
+    def sort(self):
+        """Build the orderings after a batch of add_post()/add_video()."""
+        # stable, so ties stay in insertion order, newest first from build_cache()
+        positions = range(len(self.post_ids))
+        self.by_time = array(
+            "I", sorted(positions, key=self.post_ts.__getitem__, reverse=True)
+        )
+        self.by_likes = array(
+            "I", sorted(self.by_time, key=self.post_likes.__getitem__, reverse=True)
+        )
+        self.post_shuffled = array("I", positions)
+        random.shuffle(self.post_shuffled)
+        positions = range(len(self.video_ids))
+        self.video_by_time = array(
+            "I", sorted(positions, key=self.video_ts.__getitem__, reverse=True)
+        )
+        self.video_shuffled = array("I", positions)
+        random.shuffle(self.video_shuffled)
+
+    def copy(self):
+        """Writable copy, loaded snapshots are backed by a read-only mmap."""
+        snapshot = TimelineSnapshot()
+        for name, typecode in self.fields:
+            value = getattr(self, name)
+            if typecode is None:
+                ids = IdTable()
+                ids.blob = bytearray(value.blob)
+                ids.offsets = to_array("Q", value.offsets)
+                value = ids
+            else:
+                value = to_array(typecode, value)
+            setattr(snapshot, name, value)
+        return snapshot
+
+    def buffers(self):
+        """(typecode, buffer) of every table, in fields order."""
+        for name, typecode in self.fields:
+            value = getattr(self, name)
+            if typecode is None:
+                yield "B", value.blob
+                yield "Q", value.offsets
+            else:
+                yield typecode, value
+
+    def merge_posts(self, rows):
+        """
+        Insert (post_id, ts, likes) rows into the orderings, rows already
+        in the snapshot are skipped.
+        :return: number of posts added
+        """
+        added = 0
+        for post_id, ts, likes in rows:
+            ts = ts or 0
+            likes = likes or 0
+            if self.find(self.post_ids, self.post_ts, self.by_time, post_id, ts):
+                continue
+            pos = len(self.post_ids)
+            self.add_post(post_id, ts, likes)
+            self.by_time.insert(bisect_desc(self.by_time, self.post_ts, ts), pos)
+            self.by_likes.insert(
+                bisect_desc(self.by_likes, self.post_likes, likes), pos
+            )
+            self.post_shuffled.insert(random.randint(0, pos), pos)
+            added += 1
+        return added
+
+    def merge_videos(self, rows):
+        """
+        Insert (media_id, ts) rows, see merge_posts().
+        """
+        added = 0
+        for media_id, ts in rows:
+            ts = ts or 0
+            if self.find(
+                self.video_ids, self.video_ts, self.video_by_time, media_id, ts
+            ):
+                continue
+            pos = len(self.video_ids)
+            self.add_video(media_id, ts)
+            self.video_by_time.insert(
+                bisect_desc(self.video_by_time, self.video_ts, ts), pos
+            )
+            self.video_shuffled.insert(random.randint(0, pos), pos)
+            added += 1
+        return added
+
+    def find(self, ids, keys, order, id, key):
+        """Whether id is in order, only entries with the same key are compared."""
+        i = bisect_desc(order, keys, key)
+        while i < len(order) and keys[order[i]] == key:
+            if ids[order[i]] == id:
+                return True
+            i += 1
+        return False
+
+
+def to_array(typecode, buffer):
+    res = array(typecode)
+    res.frombytes(memoryview(buffer).cast("B"))
+    return res
+
+
+timeline_file_magic = b"MTSNAP"
+# bump when the layout of TimelineSnapshot.fields changes
+timeline_file_version = 2
+# magic, version, db_id, generation, padded to 32 bytes so the tables
+# after it start 8 byte aligned
+timeline_file_header = struct.Struct("<6sIqq6x")
+
+
+def timeline_file():
+    return os.path.join(config.cache_path, "timeline.snapshot")
+
+
+def save_timeline(snapshot: TimelineSnapshot, db_id):
+    """
+    Write the snapshot for the next start, see load_timeline(). Each table
+    is stored as its length in bytes and the raw array, padded to 8 bytes.
+    """
+    path = timeline_file()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(
+            timeline_file_header.pack(
+                timeline_file_magic,
+                timeline_file_version,
+                db_id,
+                snapshot.generation,
+            )
+        )
+        for _, buffer in snapshot.buffers():
+            data = memoryview(buffer).cast("B")
+            f.write(struct.pack("<Q", len(data)))
+            f.write(data)
+            f.write(b"\0" * (-len(data) % 8))
+    # readers that mapped the old file keep their copy
+    os.replace(tmp_path, path)
+
+
+def load_timeline(db_id):
+    """
+    Map the snapshot written by save_timeline(), tables are used straight
+    from the page cache without copying or parsing.
+    :return: TimelineSnapshot, or None if there's no usable file
+    """
+    try:
+        with open(timeline_file(), "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    view = memoryview(buffer)
+    try:
+        magic, version, file_db_id, generation = timeline_file_header.unpack_from(
+            view
+        )
+        if (
+            magic != timeline_file_magic
+            or version != timeline_file_version
+            or file_db_id != db_id
+        ):
+            return None
+        offset = timeline_file_header.size
+        snapshot = TimelineSnapshot()
+        snapshot.generation = generation
+        for name, typecode in snapshot.fields:
+            tables = []
+            for typecode in ("B", "Q") if typecode is None else (typecode,):
+                (size,) = struct.unpack_from("<Q", view, offset)
+                offset += 8
+                if offset + size > len(view):
+                    raise ValueError("truncated")
+                tables.append(view[offset : offset + size].cast(typecode))
+                offset += size + (-size % 8)
+            if len(tables) == 2:
+                ids = IdTable()
+                ids.blob, ids.offsets = tables
+                tables = [ids]
+            setattr(snapshot, name, tables[0])
+    except (struct.error, ValueError, TypeError) as e:
+        logger.log(f"Ignoring broken timeline snapshot: {e}", type="warning")
+        return None
+    return snapshot
+
+
+def bisect_desc(order, keys, key):
+    """First index in order, sorted by keys descending, with keys <= key."""
+    lo, hi = 0, len(order)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if keys[order[mid]] > key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
 
 
 class Database:
     def __init__(self, db_file, fav_db_file):
+        self.db_file = db_file
+        self.fav_db_file = fav_db_file
+        # the only connection that writes, guarded by db_lock. fav.db is
+        # attached to it and to the read connections as favdb, so favorites
+        # can be joined with posts
         self.conn = sqlite3.connect(db_file, check_same_thread=False)
-        self.fav_conn = sqlite3.connect(fav_db_file, check_same_thread=False)
-        self.cached_query_words = dict()
+        self.conn.execute("ATTACH DATABASE ? AS favdb", (fav_db_file,))
+        for schema in ("main", "favdb"):
+            # readers don't block on the writer, and each other, in WAL mode
+            self.conn.execute(f"PRAGMA {schema}.journal_mode=WAL")
+            self.conn.execute(f"PRAGMA {schema}.synchronous=NORMAL")
+        # INSERT OR REPLACE only fires the delete triggers keeping posts_fts
+        # in sync with this on
+        self.conn.execute("PRAGMA recursive_triggers=ON")
+        self.has_fts = False
+        # read connections are opened per thread, see read_conn()
+        self.local = threading.local()
         self.last_text_query_time = -1
         self.db_lock = threading.Lock()
+        # cache tags of uncommitted writes, invalidated on commit()
+        self.pending_tags = set()
+
+    def read_conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file)
+            conn.execute("ATTACH DATABASE ? AS favdb", (self.fav_db_file,))
+            conn.execute("PRAGMA query_only=1")
+            self.local.conn = conn
+        return conn
 
     def prepare_db(self):
         cursor = self.conn.cursor()
@@ -67,18 +541,209 @@ class Database:
         )
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_media_post_id ON media(post_id)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_media_uid ON media(uid)")
-        fav_cursor = self.fav_conn.cursor()
-        fav_cursor.execute(
-            """CREATE TABLE IF NOT EXISTS fav (
+        # epoch seconds parsed from the time column, used for all ordering
+        if self.add_column(cursor, "posts", "ts", "INTEGER"):
+            self.backfill_ts(cursor, "posts")
+        if self.add_column(cursor, "media", "ts", "INTEGER"):
+            self.backfill_ts(cursor, "media")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_ts ON posts(ts)")
+        # video/image/audio/flash/attachment, see media_kind()
+        if self.add_column(cursor, "media", "kind", "TEXT"):
+            logger.log("Filling in media.kind...")
+            cursor.executemany(
+                "UPDATE media SET kind = ? WHERE rowid = ?",
+                [
+                    (media_kind(file_name), rowid)
+                    for rowid, file_name in cursor.execute(
+                        "SELECT rowid, file_name FROM media"
+                    ).fetchall()
+                ],
+            )
+        # queries must use the literal kind = 'video' for these to apply
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_media_video_uid_ts ON media(uid, ts, media_id) WHERE kind = 'video'"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_media_video_ts ON media(ts, media_id) WHERE kind = 'video'"
+        )
+        # text_content and description linkified by utils.embed_hyperlink() at
+        # ingest, html_ver is the utils.render_version they were rendered with
+        self.add_column(cursor, "posts", "text_html", "TEXT")
+        self.add_column(cursor, "posts", "html_ver", "TEXT")
+        self.add_column(cursor, "users", "description_html", "TEXT")
+        self.add_column(cursor, "users", "html_ver", "TEXT")
+        # edits that bypass insert_or_update_*() leave the HTML stale
+        cursor.execute(
+            """CREATE TRIGGER IF NOT EXISTS posts_html_au AFTER UPDATE OF text_content, type ON posts BEGIN
+            UPDATE posts SET html_ver = NULL WHERE rowid = new.rowid;
+            END"""
+        )
+        cursor.execute(
+            """CREATE TRIGGER IF NOT EXISTS users_html_au AFTER UPDATE OF description, type ON users BEGIN
+            UPDATE users SET html_ver = NULL WHERE rowid = new.rowid;
+            END"""
+        )
+        # covering indexes for paging through a user's posts, see query_page()
+        cursor.execute("DROP INDEX IF EXISTS idx_posts_uid_ts")
+        cursor.execute("DROP INDEX IF EXISTS idx_media_uid_ts")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_posts_uid_ts_id ON posts(uid, ts, post_id)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_media_uid_ts_id ON media(uid, ts, media_id)"
+        )
+        # what the last scan saw in each user directory, see get_changed_files()
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS scan_manifest (
+            uid TEXT,
+            kind TEXT,
+            dir_mtime REAL,
+            file_count INTEGER,
+            files TEXT,
+            PRIMARY KEY (uid, kind)
+        )"""
+        )
+        # generation is bumped by every commit that changes the rows the
+        # timeline caches are built from, see commit(), db_id tells
+        # databases apart
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)"
+        )
+        cursor.execute("INSERT OR IGNORE INTO meta VALUES ('generation', 0)")
+        cursor.execute(
+            "INSERT OR IGNORE INTO meta VALUES ('db_id', ?)", (random.getrandbits(63),)
+        )
+        # per row triggers used to do this, they slowed bulk upserts down
+        for table in ("posts", "media"):
+            for name in ("ai", "ad", "au"):
+                cursor.execute(f"DROP TRIGGER IF EXISTS {table}_gen_{name}")
+        # size of the media file on disk, see media_file_size()
+        self.add_column(cursor, "media", "bytes", "INTEGER")
+        # per user numbers kept up to date by the scanners, see refresh_user_stats()
+        has_user_stats = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_stats'"
+        ).fetchone()
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS user_stats (
+            uid TEXT PRIMARY KEY,
+            post_count INTEGER,
+            media_count INTEGER,
+            video_count INTEGER,
+            bytes INTEGER,
+            newest_ts INTEGER
+        )"""
+        )
+        self.has_fts = self.prepare_fts(cursor)
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS favdb.fav (
             post_id TEXT PRIMARY KEY,
             fav_time TEXT
         )"""
         )
-        fav_cursor.close()
-        self.fav_conn.commit()
+        # fav_time as epoch seconds, for the since= filter of /api/favs
+        if self.add_column(cursor, "fav", "fav_ts", "INTEGER"):
+            rows = cursor.execute("SELECT rowid, fav_time FROM fav").fetchall()
+            cursor.executemany(
+                "UPDATE fav SET fav_ts = ? WHERE rowid = ?",
+                [(parse_fav_time(row[1]), row[0]) for row in rows],
+            )
+        cursor.execute("CREATE INDEX IF NOT EXISTS favdb.idx_fav_ts ON fav(fav_ts)")
         cursor.close()
+        if not has_user_stats:
+            logger.log("Counting posts and media of every user...")
+            self.refresh_user_stats()
         self.conn.commit()
 
+    def add_column(self, cursor, table, column, decl):
+        """
+        Add a column to an existing table, columns are always appended so
+        row indexes of SELECT * stay the same.
+        :return: True if the column was added
+        """
+        columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+        if column in columns:
+            return False
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        return True
+
+    def backfill_ts(self, cursor, table):
+        logger.log(f"Filling in {table}.ts...")
+        rows = cursor.execute(f"SELECT rowid, time FROM {table}").fetchall()
+        cursor.executemany(
+            f"UPDATE {table} SET ts = ? WHERE rowid = ?",
+            [(utils.parse_time(row[1]), row[0]) for row in rows],
+        )
+
+    def prepare_fts(self, cursor):
+        """
+        Full text index over the searchable post columns, kept in sync with
+        the posts table by triggers. The trigram tokenizer keeps the substring
+        semantics of the LIKE search it replaces.
+        :return: False if this sqlite build has no FTS5 trigram support
+        """
+        exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'posts_fts'"
+        ).fetchall()
+        try:
+            cursor.execute(
+                """CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+                text_content, nick, uid, real_user,
+                content='posts', tokenize='trigram'
+            )"""
+            )
+        except sqlite3.OperationalError as e:
+            logger.log(
+                f"warning: no full text search ({e}), falling back to LIKE.",
+                type="warning",
+            )
+            return False
+        cursor.execute(
+            """CREATE TRIGGER IF NOT EXISTS posts_fts_ai AFTER INSERT ON posts BEGIN
+            INSERT INTO posts_fts(rowid, text_content, nick, uid, real_user)
+            VALUES (new.rowid, new.text_content, new.nick, new.uid, new.real_user);
+        END"""
+        )
+        cursor.execute(
+            """CREATE TRIGGER IF NOT EXISTS posts_fts_ad AFTER DELETE ON posts BEGIN
+            INSERT INTO posts_fts(posts_fts, rowid, text_content, nick, uid, real_user)
+            VALUES ('delete', old.rowid, old.text_content, old.nick, old.uid, old.real_user);
+        END"""
+        )
+        cursor.execute(
+            """CREATE TRIGGER IF NOT EXISTS posts_fts_au
+            AFTER UPDATE OF text_content, nick, uid, real_user ON posts BEGIN
+            INSERT INTO posts_fts(posts_fts, rowid, text_content, nick, uid, real_user)
+            VALUES ('delete', old.rowid, old.text_content, old.nick, old.uid, old.real_user);
+            INSERT INTO posts_fts(rowid, text_content, nick, uid, real_user)
+            VALUES (new.rowid, new.text_content, new.nick, new.uid, new.real_user);
+        END"""
+        )
+        if not exists:
+            logger.log("Building full text index...")
+            cursor.execute("INSERT INTO posts_fts(posts_fts) VALUES ('rebuild')")
+        return True
+
+    def text_match(self, words):
+        """
+        WHERE clause matching posts that contain all words.
+        :return: tuple of (sql, params)
+        """
+        # trigrams need at least 3 characters, shorter words use LIKE
+        fts_words = [w for w in words if len(w) >= 3] if self.has_fts else []
+        like_words = [w for w in words if w not in fts_words]
+        clauses = ["(text_content || nick || uid || real_user) LIKE ?"] * len(
+            like_words
+        )
+        params = [f"%{word}%" for word in like_words]
+        if fts_words:
+            clauses.insert(
+                0, "rowid IN (SELECT rowid FROM posts_fts WHERE posts_fts MATCH ?)"
+            )
+            params.insert(
+                0, " AND ".join('"' + w.replace('"', '""') + '"' for w in fts_words)
+            )
+        return " AND ".join(clauses), tuple(params)
+
     def insert_or_update_user(
         self,
         uid,
@@ -95,9 +760,12 @@ class Database:
         if not update_time:
             update_time = time.time()
         with self.db_lock:
+            self.pending_tags.update(("users", f"users:{uid}"))
             cursor = self.conn.cursor()
             cursor.execute(
-                "INSERT OR REPLACE INTO users VALUES (?,?,?,?,?,?,?,?,?,?)",
+                """INSERT OR REPLACE INTO users (uid, user_name, udid, nick, avatar,
+                banner, description, type, update_time, flagged, description_html,
+                html_ver) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)""",
                 (
                     uid,
                     user_name,
@@ -109,6 +777,8 @@ class Database:
                     type,
                     update_time,
                     flagged,
+                    utils.embed_hyperlink(type, description),
+                    utils.render_version,
                 ),
             )
             cursor.close()
@@ -130,10 +800,8 @@ class Database:
         reply_to="",
         real_user="",
     ):
-        with self.db_lock:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "INSERT OR REPLACE INTO posts VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+        self.insert_or_update_posts(
+            [
                 (
                     post_id,
                     text_content,
@@ -149,132 +817,438 @@ class Database:
                     isreply,
                     reply_to,
                     real_user,
-                ),
+                )
+            ]
+        )
+
+    def insert_or_update_posts(self, rows):
+        rows = [
+            row
+            + (
+                utils.parse_time(row[4]),
+                utils.embed_hyperlink(row[5], row[1]),
+                utils.render_version,
+            )
+            for row in rows
+        ]
+        with self.db_lock:
+            self.pending_tags.add("posts")
+            self.pending_tags.update(f"posts:{row[2]}" for row in rows)
+            cursor = self.conn.cursor()
+            cursor.executemany(
+                """INSERT OR REPLACE INTO posts (post_id, text_content, uid, nick,
+                time, type, url, likes, reposts, comments, embed, isreply,
+                reply_to, real_user, ts, text_html, html_ver)
+                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+                rows,
             )
             cursor.close()
 
     def insert_or_update_media(self, media_id, post_id, file_name, uid, type, time):
+        self.insert_or_update_medias([(media_id, post_id, file_name, uid, type, time)])
+
+    def insert_or_update_medias(self, rows):
+        rows = [
+            row
+            + (
+                utils.parse_time(row[5]),
+                media_kind(row[2]),
+                media_file_size(row[3], row[4], row[2]),
+            )
+            for row in rows
+        ]
+        with self.db_lock:
+            self.pending_tags.add("media")
+            self.pending_tags.update(f"media:{row[3]}" for row in rows)
+            cursor = self.conn.cursor()
+            cursor.executemany(
+                """INSERT OR REPLACE INTO media (media_id, post_id, file_name, uid,
+                type, time, ts, kind, bytes) VALUES (?,?,?,?,?,?,?,?,?)""",
+                rows,
+            )
+            cursor.close()
+
+    def refresh_user_stats(self, uids=None):
+        """
+        Recount the user_stats of uids, of every user if None. Sees the
+        writes of the current transaction, call it before commit().
+        """
+        with self.db_lock:
+            cursor = self.conn.cursor()
+            self.pending_tags.add("user_stats")
+            if uids is None:
+                cursor.execute("DELETE FROM user_stats")
+                cursor.execute(all_user_stats_sql)
+            else:
+                uids = list(uids)
+                for i in range(0, len(uids), in_query_chunk_size):
+                    chunk = uids[i : i + in_query_chunk_size]
+                    cursor.execute(
+                        user_stats_sql.format(
+                            uids="VALUES " + ",".join(["(?)"] * len(chunk))
+                        ),
+                        chunk,
+                    )
+            cursor.close()
+
+    def get_user_stats(self, uid):
+        """
+        :return: (post_count, media_count, video_count, bytes, newest_ts),
+            all zero or None for users without posts
+        """
+        rows = self.raw_query(
+            (
+                "SELECT post_count, media_count, video_count, bytes, newest_ts FROM user_stats WHERE uid = ?",
+                (uid,),
+            )
+        )
+        return rows[0] if rows else (0, 0, 0, 0, None)
+
+    def get_scan_manifest(self, uid, kind):
+        rows = self.raw_query(
+            (
+                "SELECT dir_mtime, file_count, files FROM scan_manifest WHERE uid = ? AND kind = ?",
+                (uid, kind),
+            ),
+            ignore_cache=True,
+        )
+        if not rows:
+            return None
+        return rows[0][0], rows[0][1], json.loads(rows[0][2])
+
+    def update_scan_manifest(self, uid, kind, dir_mtime, files):
         with self.db_lock:
             cursor = self.conn.cursor()
             cursor.execute(
-                "INSERT OR REPLACE INTO media VALUES (?,?,?,?,?,?)",
-                (media_id, post_id, file_name, uid, type, time),
+                "INSERT OR REPLACE INTO scan_manifest VALUES (?,?,?,?,?)",
+                (uid, kind, dir_mtime, len(files), json.dumps(files)),
             )
             cursor.close()
 
-    def query_rows(self, selected_db, key, value, ignore_cache=False, sort_key=None):
+    def query_rows(self, selected_db, key, value, ignore_cache=False, order_by=""):
+        order_by = f" ORDER BY {order_by}" if order_by else ""
         if key:
             if isinstance(key, list):
                 key = " AND ".join([f"{k} = ?" for k in key])
                 value = tuple(value)
                 res = self.raw_query(
-                    (f"SELECT * FROM {selected_db} WHERE {key}", value),
+                    (f"SELECT * FROM {selected_db} WHERE {key}{order_by}", value),
                     selected_db=selected_db,
                     ignore_cache=ignore_cache,
                 )
             else:
                 res = self.raw_query(
-                    (f"SELECT * FROM {selected_db} WHERE {key} = ?", (value,)),
+                    (
+                        f"SELECT * FROM {selected_db} WHERE {key} = ?{order_by}",
+                        (value,),
+                    ),
                     selected_db=selected_db,
                     ignore_cache=ignore_cache,
+                    # writes to other users' rows don't touch this result
+                    tags=(f"{selected_db}:{value}",) if key == "uid" else None,
                 )
         else:
             res = self.raw_query(
-                f"SELECT * FROM {selected_db}",
+                f"SELECT * FROM {selected_db}{order_by}",
                 selected_db=selected_db,
                 ignore_cache=ignore_cache,
             )
-        if sort_key:
-            res = natsort.natsorted(res, key=sort_key, reverse=True)
         return res
 
-    def raw_query(self, sql, selected_db="main", ignore_cache=False):
-        global query_cache
-        if len(query_cache) > 5000:
-            # logger.log("Clear query cache.")
-            query_cache = dict()
-        if sql in query_cache and not ignore_cache:
-            if debug_mode:
-                logger.log("Use cached raw query for", sql, verbose=2)
-            return query_cache[sql]
+    def query_page(self, table, uid, page, per_page):
+        """
+        One page of a user's posts or media, newest first. Pages are read
+        from the (uid, ts, id) index starting after the last row of the
+        previous page, so deep pages cost the same as the first one.
+        :param table: "posts" or "media"
+        :return: list of (ts, post_id or media_id)
+        """
+        id_col = "post_id" if table == "posts" else "media_id"
+        tags = (f"{table}:{uid}",)
+        generation = query_cache.generation
+        after = None
+        if page > 0:
+            after = query_cache.get(("page_cursor", table, uid, per_page, page))
+            if after is None:
+                # no cursor yet for this page, jump there through the index
+                rows = self.raw_query(
+                    (
+                        f"SELECT ts, {id_col} FROM {table} WHERE uid = ? "
+                        f"ORDER BY ts DESC, {id_col} DESC LIMIT 1 OFFSET ?",
+                        (uid, page * per_page - 1),
+                    ),
+                    tags=tags,
+                )
+                if not rows:
+                    return []
+                after = rows[0]
+        if after is None:
+            sql = (
+                f"SELECT ts, {id_col} FROM {table} WHERE uid = ? "
+                f"ORDER BY ts DESC, {id_col} DESC LIMIT ?",
+                (uid, per_page),
+            )
         else:
-            with self.db_lock:
-                if selected_db == "fav":
-                    cursor = self.fav_conn.cursor()
-                else:
-                    cursor = self.conn.cursor()
-                if type(sql) == str:
-                    sql = sql.strip()
-                    cursor.execute(sql)
-                elif type(sql) in (list, tuple):
-                    cursor.execute(*sql)
-                else:
-                    raise ValueError("sql must be a string or a tuple/list")
-                res = cursor.fetchall()
-                cursor.close()
-            if not ignore_cache:
-                query_cache[sql] = res
-            return res
+            sql = (
+                f"SELECT ts, {id_col} FROM {table} WHERE uid = ? "
+                f"AND (ts, {id_col}) < (?, ?) "
+                f"ORDER BY ts DESC, {id_col} DESC LIMIT ?",
+                (uid, after[0], after[1], per_page),
+            )
+        rows = self.raw_query(sql, tags=tags)
+        if len(rows) == per_page:
+            query_cache.put(
+                ("page_cursor", table, uid, per_page, page + 1),
+                tuple(rows[-1]),
+                tags,
+                generation=generation,
+            )
+        return rows
+
+    def query_reply_chains(self, post_ids, max_depth=None):
+        """
+        Resolve the posts each of post_ids replies to, up to the thread
+        root, in one recursive query. A chain stops at a post that isn't
+        in the database, at a post already in the chain, or at max_depth.
+        :return: dict of post_id -> list of (post_id, user_name, type) of its
+            ancestors, the direct parent first. The last one may be missing
+            from the database, user_name and type are then all there is.
+        """
+        if max_depth is None:
+            max_depth = config.reply_chain_max_depth
+        post_ids = list(dict.fromkeys(post_ids))
+        if not post_ids:
+            return dict()
+        seeds = ",".join(["(?)"] * len(post_ids))
+        # the path of visited ids, ',id,' each, detects loops in replies
+        parent = "substr(posts.reply_to, 1, instr(posts.reply_to, '@') - 1)"
+        sql = f"""WITH RECURSIVE
+            seed(post_id) AS (VALUES {seeds}),
+            chain(root, depth, post_id, user_name, type, path) AS (
+                SELECT post_id, 0, post_id, NULL, NULL, ',' || post_id || ','
+                FROM seed
+                UNION ALL
+                SELECT chain.root, chain.depth + 1, {parent},
+                    substr(posts.reply_to, instr(posts.reply_to, '@') + 1),
+                    posts.type, chain.path || {parent} || ','
+                FROM chain JOIN posts ON posts.post_id = chain.post_id
+                WHERE posts.isreply AND instr(posts.reply_to, '@') > 1
+                    AND chain.depth < ?
+                    AND instr(chain.path, ',' || {parent} || ',') = 0
+            )
+            SELECT root, post_id, user_name, type FROM chain
+            WHERE depth > 0 ORDER BY root, depth"""
+        chains = dict()
+        for root, post_id, user_name, type in self.raw_query(
+            (sql, tuple(post_ids) + (max_depth,))
+        ):
+            chains.setdefault(root, []).append((post_id, user_name, type))
+        return chains
+
+    def query_in(
+        self, selected_db, key, values, ignore_cache=False, columns="*", join=""
+    ):
+        """
+        Rows whose key is one of values, in chunks of in_query_chunk_size to
+        stay under sqlite's variable limit.
+        :param join: JOIN clause added after the table
+        """
+        res = []
+        values = list(values)
+        for i in range(0, len(values), in_query_chunk_size):
+            chunk = tuple(values[i : i + in_query_chunk_size])
+            placeholders = ",".join("?" * len(chunk))
+            res += self.raw_query(
+                (
+                    f"SELECT {columns} FROM {selected_db} {join} WHERE {key} IN ({placeholders})",
+                    chunk,
+                ),
+                selected_db=selected_db,
+                ignore_cache=ignore_cache,
+            )
+        return res
+
+    def raw_query(self, sql, selected_db="main", ignore_cache=False, tags=None):
+        """
+        Run a read query, results are cached in query_cache until a commit
+        touches one of their tags.
+        :param selected_db: unused, fav.db is attached to the connection
+        :param tags: cache tags, defaults to the tables the query reads
+        """
+        if not ignore_cache:
+            res = query_cache.get(sql)
+            if res is not None:
+                if debug_mode:
+                    logger.log("Use cached raw query for", sql, verbose=2)
+                return res
+        generation = query_cache.generation
+        # reads only see committed data, writes go through execute()
+        cursor = self.read_conn().cursor()
+        if type(sql) == str:
+            sql = sql.strip()
+            cursor.execute(sql)
+        elif type(sql) in (list, tuple):
+            cursor.execute(*sql)
+        else:
+            raise ValueError("sql must be a string or a tuple/list")
+        res = cursor.fetchall()
+        cursor.close()
+        if not ignore_cache:
+            if tags is None:
+                tags = query_tables(sql if type(sql) == str else sql[0])
+            query_cache.put(sql, res, tags, generation=generation)
+        return res
+
+    def iter_query(self, sql, params=(), batch_size=1000):
+        """
+        Uncached read query whose rows are yielded as they are fetched, for
+        results too big to hold in memory. Iterate it in the thread it was
+        created in, read connections are per thread.
+        """
+        cursor = self.read_conn().cursor()
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+    def execute(self, sql, params=(), selected_db="main", tags=()):
+        """
+        Run a write query.
+        :param selected_db: unused, fav.db is attached to the connection
+        :param tags: cache tags to invalidate on the next commit
+        """
+        with self.db_lock:
+            self.pending_tags.update(tags)
+            cursor = self.conn.cursor()
+            cursor.execute(sql, params)
+            cursor.close()
 
     def query_post_by_text(self, text_content):
-        global cached_query_words
+        """Results are cached in query_cache, like any raw_query()."""
         text_content = text_content.strip()
         words = tuple(
-            set([i.lstrip("u/") for i in text_content.split() if i and i != " "])
+            sorted(set([i.lstrip("u/") for i in text_content.split() if i and i != " "]))
         )
-        if words in self.cached_query_words:
-            if abs(self.cached_query_words[words][0] - time.time()) > 1200:
-                logger.log("Clear outdated query cache.", verbose=1)
-                self.cached_query_words = dict()
-            else:
-                logger.log("Use cached query for", words, verbose=1)
-                return self.cached_query_words[words][1]
         logger.log("Querying posts by text:", words, verbose=1)
-        placeholders = " AND ".join(
-            ["(text_content || nick || uid || real_user) LIKE ?"] * len(words)
+        placeholders, params = self.text_match(words)
+        sql_query = (
+            f"SELECT post_id, ts FROM posts WHERE {placeholders} ORDER BY ts DESC"
         )
-        sql_query = f"SELECT post_id, time FROM posts WHERE {placeholders}"
-        params = tuple([f"%{word}%" for word in words])
-        res = self.raw_query((sql_query, params))
-        res = natsort.natsorted(res, key=lambda x: x[1], reverse=True)
-        self.cached_query_words[words] = (time.time(), res)
-        return res
+        return self.raw_query((sql_query, params))
 
     def query_media_by_text(self, text_content):
-        global cache_query_media_id
+        """Results are cached in query_cache, like any raw_query()."""
         text_content = text_content.strip()
         words = tuple(
-            set([i.lstrip("u/") for i in text_content.split() if i and i != " "])
+            sorted(set([i.lstrip("u/") for i in text_content.split() if i and i != " "]))
         )
-        if words in cache_query_media_id:
-            if abs(cache_query_media_id[words][0] - time.time()) > 1200:
-                logger.log("Clear outdated query cache.", verbose=1)
-                cache_query_media_id = dict()
-            else:
-                logger.log("Use cached query for", words, verbose=1)
-                return cache_query_media_id[words][1]
         logger.log("Querying media by text:", words)
-        placeholders = " AND ".join(
-            ["(text_content || ' ' || nick || real_user) LIKE ?"] * len(words)
-        )
-        sql_query = f"SELECT media_id, time FROM media WHERE (file_name LIKE '%.mp4' OR file_name LIKE '%.webm' OR file_name LIKE '%.m4v') AND post_id IN (SELECT post_id FROM posts WHERE {placeholders})"
-        params = tuple([f"%{word}%" for word in words])
-        res = self.raw_query((sql_query, params))
-        res = natsort.natsorted(res, key=lambda x: x[1], reverse=True)
-        if res:
-            res = [i[0] for i in res]
-            cache_query_media_id[words] = (time.time(), res)
-        else:
-            cache_query_media_id[words] = (time.time(), [])
-        return cache_query_media_id[words][1]
+        placeholders, params = self.text_match(words)
+        sql_query = f"SELECT media_id, ts FROM media WHERE kind = 'video' AND post_id IN (SELECT post_id FROM posts WHERE {placeholders}) ORDER BY ts DESC"
+        return [i[0] for i in self.raw_query((sql_query, params))]
 
     def commit(self):
-        self.conn.commit()
-        self.fav_conn.commit()
+        with self.db_lock:
+            if self.pending_tags & {"posts", "media"}:
+                self.conn.execute(bump_generation_sql)
+            self.conn.commit()
+            tags = self.pending_tags
+            self.pending_tags = set()
+        query_cache.invalidate(tags)
+
+    def get_meta(self, key):
+        rows = self.raw_query(
+            ("SELECT value FROM meta WHERE key = ?", (key,)), ignore_cache=True
+        )
+        return rows[0][0] if rows else None
+
+    def analyze(self):
+        """
+        Refresh the query planner statistics, without them sqlite won't
+        prefer the partial kind = 'video' indexes. analysis_limit keeps
+        this quick on large databases.
+        """
+        with self.db_lock:
+            self.conn.execute("PRAGMA analysis_limit=1000")
+            self.conn.execute("ANALYZE")
+            self.conn.commit()
 
     def clear_cache(self):
-        global query_cache
-        query_cache = dict()
+        query_cache.clear()
+
+
+class IngestBatch:
+    """
+    Write buffer for the scanners, has the same insert_or_update_post/media
+    interface as Database so it can be handed to save_to_db().
+    Rows are written with executemany, one transaction per flush.
+    """
+
+    def __init__(self, db: Database, batch_size=None):
+        self.db = db
+        self.batch_size = batch_size or config.ingest_batch_size
+        self.posts = []
+        self.medias = []
+
+    def insert_or_update_post(
+        self,
+        post_id,
+        text_content,
+        uid,
+        nick,
+        time,
+        type,
+        url,
+        likes,
+        reposts,
+        comments,
+        embed,
+        isreply,
+        reply_to="",
+        real_user="",
+    ):
+        self.posts.append(
+            (
+                post_id,
+                text_content,
+                uid,
+                nick,
+                time,
+                type,
+                url,
+                likes,
+                reposts,
+                comments,
+                embed,
+                isreply,
+                reply_to,
+                real_user,
+            )
+        )
+        if len(self.posts) >= self.batch_size:
+            self.flush()
+
+    def insert_or_update_media(self, media_id, post_id, file_name, uid, type, time):
+        self.medias.append((media_id, post_id, file_name, uid, type, time))
+        if len(self.medias) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.posts:
+            self.db.insert_or_update_posts(self.posts)
+        if self.medias:
+            self.db.insert_or_update_medias(self.medias)
+        uids = {row[2] for row in self.posts} | {row[3] for row in self.medias}
+        if uids:
+            self.db.refresh_user_stats(uids)
+        self.db.commit()
+        self.posts = []
+        self.medias = []
 
 
 class Embed:
@@ -294,33 +1268,39 @@ class Embed:
             self.url = f"https://bsky.app/profile/{self.udid}/post/{self.post_id}"
 
     def load_from_db(self, db):
+        user_rows = db.query_rows("users", "udid", self.udid)
+        post_rows = db.query_rows("posts", "post_id", self.post_id) if user_rows else []
+        media_rows = db.query_rows("media", "post_id", self.post_id) if post_rows else []
+        return self.load_from_rows(
+            user_rows[0] if user_rows else None,
+            post_rows[0] if post_rows else None,
+            media_rows,
+        )
+
+    def load_from_rows(self, user_row, post_row, media_rows):
         # check if user exists
-        rows = db.query_rows("users", "udid", self.udid)
-        if len(rows) == 0:
+        if user_row is None:
             logger.log(f"User {self.udid} not found in database")
             return False
-        self.uid = rows[0][0]
-        self.user_name = rows[0][1]
-        self.nick = rows[0][3]
+        self.uid = user_row[0]
+        self.user_name = user_row[1]
+        self.nick = user_row[3]
         # check if post exists
-        rows = db.query_rows("posts", "post_id", self.post_id)
-        if len(rows) == 0:
+        if post_row is None:
             logger.log(f"Post {self.post_id} not found in database")
             return False
-        self.text_content = rows[0][1]
-        self.text_content = utils.embed_hyperlink(self.type, self.text_content)
-        self.time = rows[0][4]
+        self.text_content = stored_html(self.type, post_row[1], post_row[15], post_row[16])
+        self.time = post_row[4]
         self.external = False
-        # find all media related to this post
-        rows = db.query_rows("media", "post_id", self.post_id)
-        for row in rows:
+        # all media related to this post
+        for row in media_rows:
             # Extract user_name from uid
             uid = row[3]
             user_name = uid.split("@")[0] if "@" in uid else uid
             media = Media(row[0], row[1], user_name, self.type, row[5])
-            media.file_name = row[2]
-            media.load_from_db(db)
+            media.load_from_row(row)
             self.medias.append(media)
+        return True
 
 
 class Post:
@@ -341,10 +1321,14 @@ class Post:
             self.real_user = ""
 
     def load_from_db(self, db: Database):
-        rows = db.query_rows("posts", "post_id", self.post_id)
+        rows = db.raw_query(("SELECT * FROM posts WHERE post_id = ?", (self.post_id,)))
         if len(rows) == 0:
             return False
-        row = rows[0]
+        self.load_from_row(rows[0])
+        self.fav = bool(fav_post_ids(db, [self.post_id]))
+        return True
+
+    def load_from_row(self, row):
         self.uid = row[2]
         # Extract user_name and type from uid if not already set
         if self.uid and "@" in self.uid:
@@ -364,15 +1348,13 @@ class Post:
         self.isreply = row[11]
         self.reply_to = row[12]
         self.real_user = row[13]
-        self.text_content = utils.embed_hyperlink(self.type, row[1])
-        # check if post is in fav
-        rows = db.query_rows("fav", "post_id", self.post_id, True)
-        if len(rows) > 0:
-            self.fav = True
-        return True
+        self.text_content = stored_html(self.type, row[1], row[15], row[16])
 
     def save_to_db(self, db):
-        db.insert_or_update_post(
+        db.insert_or_update_post(*self.to_row())
+
+    def to_row(self):
+        return (
             self.post_id,
             self.text_content,
             self.uid,
@@ -390,6 +1372,10 @@ class Post:
         )
 
     def load_from_json(self, json, db):
+        self.parse_json(json)
+        self.save_to_db(db)
+
+    def parse_json(self, json):
         if self.type == "x":
             self.post_id = str(json["tweet_id"])
             self.text_content = json["content"]
@@ -471,22 +1457,30 @@ class Post:
             self.real_user = self.user_name
         # Set uid after user_name and type are determined
         self.uid = f"{self.user_name}@{self.type}"
-        self.save_to_db(db)
 
     def init_embed(self, db):
-        if self.embed:
-            if self.type == "bsky":
-                *_, embed_udid, _, embed_post_id = self.embed.split("/")
-                self.embed_url = (
-                    f"https://bsky.app/profile/{embed_udid}/post/{embed_post_id}"
-                )
-            elif self.type == "x":
-                embed_udid, embed_post_id = self.embed.split("/")[-2:]
-                self.embed_url = f"https://x.com/{embed_udid}/status/{embed_post_id}"
-            embed = Embed(embed_post_id, embed_udid, self.type)
+        target = self.embed_target()
+        if target:
+            embed = Embed(target[1], target[0], self.type)
             embed.load_from_db(db)
             self.embed_obj = embed
-    
+
+    def embed_target(self):
+        """
+        :return: tuple of (embed_udid, embed_post_id), or None if the post has no embed
+        """
+        if not self.embed:
+            return None
+        if self.type == "bsky":
+            *_, embed_udid, _, embed_post_id = self.embed.split("/")
+            self.embed_url = f"https://bsky.app/profile/{embed_udid}/post/{embed_post_id}"
+        elif self.type == "x":
+            embed_udid, embed_post_id = self.embed.split("/")[-2:]
+            self.embed_url = f"https://x.com/{embed_udid}/status/{embed_post_id}"
+        else:
+            return None
+        return embed_udid, embed_post_id
+
     def concat_url(self):
         if self.type == "x":
             self.url = f"https://x.com/{self.user_name}/status/{self.post_id}"
@@ -514,6 +1508,12 @@ class User:
         self.banner = ""
         self.description = ""
         self.url = ""
+        # from user_stats, see load_stats()
+        self.post_count = 0
+        self.media_count = 0
+        self.video_count = 0
+        self.bytes = 0
+        self.newest_ts = None
 
     def load_from_db(self, db, ignore_cache=False):
         if self.placeholder:
@@ -525,15 +1525,17 @@ class User:
             rows = db.query_rows("users", "user_name", self.user_name, ignore_cache)
         if len(rows) == 0:
             return False
+        return self.load_from_row(rows[0])
+
+    def load_from_row(self, row):
         try:
-            row = rows[0]
             self.uid = row[0]
             self.user_name = row[1]
             self.udid = row[2]
             self.nick = row[3]
             self.avatar = row[4]
             self.banner = row[5]
-            self.description = utils.embed_hyperlink(self.type, row[6])
+            self.description = stored_html(self.type, row[6], row[10], row[11])
             self.type = row[7]
             self.update_time = row[8]
             self.flagged = row[9]
@@ -545,7 +1547,7 @@ class User:
             logger.log(
                 f"Error loading user {self.user_name} from database: {e}", type="error"
             )
-            logger.log(rows, type="error")
+            logger.log(row, type="error")
             return False
 
     def load_from_inline(
@@ -689,6 +1691,34 @@ class User:
     def get_update_time_str(self):
         return time.strftime("%Y-%m-%d %H:%M", time.localtime(self.update_time))
 
+    def load_stats(self, row):
+        """
+        :param row: (post_count, media_count, video_count, bytes, newest_ts)
+        """
+        (
+            self.post_count,
+            self.media_count,
+            self.video_count,
+            self.bytes,
+            self.newest_ts,
+        ) = row
+
+    def get_size_str(self):
+        size = self.bytes or 0
+        for unit in ("B", "KB", "MB", "GB"):
+            if size < 1024:
+                break
+            size /= 1024
+        else:
+            unit = "TB"
+        return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+    def get_newest_time_str(self):
+        if not self.newest_ts:
+            return ""
+        # ts holds the post time string as if it were UTC, see utils.parse_time()
+        return time.strftime("%Y-%m-%d %H:%M", time.gmtime(self.newest_ts))
+
 
 class Media:
     def __init__(self, media_id, post_id, user_name, type, time):
@@ -713,7 +1743,9 @@ class Media:
         rows = db.query_rows("media", "media_id", self.media_id)
         if len(rows) == 0:
             return False
-        row = rows[0]
+        return self.load_from_row(rows[0])
+
+    def load_from_row(self, row):
         try:
             self.post_id = row[1]
             self.file_name = row[2]
@@ -729,18 +1761,44 @@ class Media:
                     self.type = parts[1]
             self.type = row[4]
             self.time = row[5]
-            self.isvideo = self.file_name.split(".")[-1] in valid_video_types
-            self.isaudio = self.file_name.split(".")[-1] in valid_audio_types
-            self.isimage = self.file_name.split(".")[-1] in valid_image_types
-            self.isflash = self.file_name.split(".")[-1] in valid_flash_types
-            self.isattachment = self.file_name.split(".")[-1] in valid_attachment_types
+            self.kind = row[7] if row[7] is not None else media_kind(self.file_name)
+            self.isvideo = self.kind == "video"
+            self.isaudio = self.kind == "audio"
+            self.isimage = self.kind == "image"
+            self.isflash = self.kind == "flash"
+            self.isattachment = self.kind == "attachment"
         except Exception as e:
             logger.log("Error:", e, type="error")
-            logger.log("Rows:", rows, type="error")
+            logger.log("Row:", row, type="error")
             return False
         return True
 
 
+def media_path(uid, type, file_name):
+    """Path of a media file from its media row, None if it can't be told."""
+    if not uid or not file_name or type not in config.fs_bases:
+        return None
+    return os.path.join(config.fs_bases[type], uid.rsplit("@", 1)[0], file_name)
+
+
+def media_file_size(uid, type, file_name):
+    """Size in bytes of a media file, None if it can't be found."""
+    path = media_path(uid, type, file_name)
+    if not path:
+        return None
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def stored_html(type, text, html, html_ver):
+    """HTML stored at ingest, rendered on the spot if it's missing or stale."""
+    if html_ver == utils.render_version:
+        return html
+    return utils.embed_hyperlink(type, text)
+
+
 def bsky_link_fix(text, facets):
     try:
         for facet in facets:
@@ -762,7 +1820,6 @@ def bsky_link_fix(text, facets):
 
 # scan for content downloaded using gallery-dl
 def scan_for_users(type, db, user_name=None):
-    global all_users
     if user_name == "ignore":
         return
     fs_base = config.fs_bases[type]
@@ -818,11 +1875,18 @@ def scan_for_users(type, db, user_name=None):
         except Exception as e:
             logger.log(e, type="error")
             logger.log("Error loading user:", user_name, type="error")
-    db.clear_cache()
-    all_users = get_users(db)
+    db.commit()
+    if len(user_names) == 1:
+        user_index.update(db, f"{user_names[0].lower()}@{type}")
+    else:
+        user_index.load(db)
 
 
-def scan_for_posts(type, db, user_name=None):
+def scan_for_posts(type, db, user_name=None, pool=None):
+    """
+    :param pool: process pool from start_ingest_pool(), used for users with
+        many changed files. Without it every file is parsed in this thread.
+    """
     if user_name == "ignore":
         return
     fs_base = config.fs_bases[type]
@@ -830,15 +1894,27 @@ def scan_for_posts(type, db, user_name=None):
         user_names = os.listdir(fs_base)
     else:
         user_names = [user_name]
+    batch = IngestBatch(db)
     for cnt, user_name in enumerate(user_names):
+        # single user rescans always list the directory, metadata files of
+        # existing posts get rewritten in place without touching the dir mtime
+        scan = get_changed_files(
+            type,
+            db,
+            user_name,
+            "posts",
+            lambda f: f.endswith(".json"),
+            quick=len(user_names) > 1,
+        )
+        if not scan:
+            continue
+        dir_mtime, json_files, manifest_files, seen_before = scan
         logger.log(
-            f"[{cnt+1}/{len(user_names)}] scanning for posts of user {user_name}".ljust(
+            f"[{cnt+1}/{len(user_names)}] scanning for posts of user {user_name}, {len(json_files)} changed".ljust(
                 90, " "
             )
         )
         sys.stdout.flush()
-        filelist = os.listdir(os.path.join(fs_base, user_name))
-        json_files = [f for f in filelist if f.endswith(".json")]
         regex_map = {
             "x": {"file_patterns": [r"\d+.+json"], "id_pattern": r"(\d+)"},
             "bsky": {
@@ -860,29 +1936,83 @@ def scan_for_posts(type, db, user_name=None):
             post_files = []
             for pat in patterns["file_patterns"]:
                 post_files += [f for f in json_files if re.match(pat, f)]
+            jobs = []
             for post_file in post_files:
                 post_id = re.match(patterns["id_pattern"], post_file).group(1)
-                post = Post(post_id, user_name, type)
-                if not post.load_from_db(db) or len(user_names) == 1:
-                    with open(
-                        os.path.join(fs_base, user_name, post_file),
-                        "r",
-                        encoding="utf=8",
-                    ) as f:
-                        try:
-                            post_json = json.load(f)
-                            post.load_from_json(post_json, db)
-                        except Exception as e:
-                            logger.log(e, type="error")
-                            logger.log(
-                                "Error loading:",
-                                os.path.join(fs_base, user_name, post_file),
-                                type="error",
-                            )
-                            if debug_mode:
-                                raise e
-    db.commit()
-    db.clear_cache()
+                # without a previous manifest, only load posts missing from the db
+                if (
+                    seen_before
+                    or len(user_names) == 1
+                    or not Post(post_id, user_name, type).load_from_db(db)
+                ):
+                    jobs.append((post_file, post_id, user_name, type))
+            if pool and len(jobs) >= parallel_parse_min_files:
+                results = pool.map(parse_post_file, jobs, chunksize=64)
+            else:
+                results = map(parse_post_file, jobs)
+            for post_file, row, error in results:
+                if row:
+                    batch.insert_or_update_post(*row)
+                    continue
+                # retry on the next scan
+                manifest_files.pop(post_file, None)
+                logger.log(error, type="error")
+                logger.log(
+                    "Error loading:",
+                    os.path.join(fs_base, user_name, post_file),
+                    type="error",
+                )
+        # the manifest is committed together with the last rows of the user
+        db.update_scan_manifest(
+            f"{user_name}@{type}", "posts", dir_mtime, manifest_files
+        )
+        batch.flush()
+
+
+def parse_post_file(job):
+    """
+    Parse one gallery-dl metadata file into a posts row.
+    Runs in the scanner's process pool, so it must not touch the database.
+    :param job: tuple of (file name, post_id, user_name, type)
+
+    :return: tuple of (file name, row or None, error or None)
+    """
+    post_file, post_id, user_name, type = job
+    post = Post(post_id, user_name, type)
+    try:
+        with open(
+            os.path.join(config.fs_bases[type], user_name, post_file),
+            "r",
+            encoding="utf=8",
+        ) as f:
+            post.parse_json(json.load(f))
+    except Exception as e:
+        if debug_mode:
+            logger.log(traceback.format_exc(), type="error")
+        return post_file, None, repr(e)
+    return post_file, post.to_row(), None
+
+
+def ingest_workers():
+    return config.ingest_workers or os.cpu_count() or 1
+
+
+def start_ingest_pool():
+    """
+    Process pool for the startup scan, see scan_for_posts(). Its workers are
+    forked right away, so call this before any other thread is started, a
+    child forked while another thread holds a lock can deadlock on it.
+    :return: the pool, None if only one worker is configured
+    """
+    if ingest_workers() <= 1:
+        return None
+    pool = ProcessPoolExecutor(
+        max_workers=ingest_workers(),
+        mp_context=multiprocessing.get_context("fork"),
+    )
+    # with fork, the first task starts all the workers at once
+    pool.submit(int).result()
+    return pool
 
 
 def scan_for_media(type, db, user_name=None):
@@ -893,18 +2023,24 @@ def scan_for_media(type, db, user_name=None):
         user_names = os.listdir(fs_base)
     else:
         user_names = [user_name]
+    batch = IngestBatch(db)
     for cnt, user_name in enumerate(user_names):
+        scan = get_changed_files(
+            type,
+            db,
+            user_name,
+            "media",
+            lambda f: f.split(".")[-1] in valid_media_types,
+            quick=len(user_names) > 1,
+        )
+        if not scan:
+            continue
+        dir_mtime, media_files, manifest_files, _ = scan
         logger.log(
-            f"[{cnt+1}/{len(user_names)}] scanning for media of user {user_name}".ljust(
+            f"[{cnt+1}/{len(user_names)}] scanning for media of user {user_name}, {len(media_files)} changed".ljust(
                 90, " "
             )
         )
-        filelist = os.listdir(os.path.join(fs_base, user_name))
-        # check if is file
-        filelist = [
-            f for f in filelist if os.path.isfile(os.path.join(fs_base, user_name, f))
-        ]
-        media_files = [f for f in filelist if f.split(".")[-1] in valid_media_types]
         for media_file in media_files:
             if type in ["x", "bsky", "reddit"]:
                 media_id = media_file.split(".")[0]
@@ -996,57 +2132,441 @@ def scan_for_media(type, db, user_name=None):
                 post.likes = 0
                 post.reposts = 0
                 post.comments = 0
-                post.save_to_db(db)
+                post.save_to_db(batch)
             media = Media(media_id, related_post_id, user_name, type, post.time)
             media.file_name = media_file
             if not media.load_from_db(db):
-                media.save_to_db(db)
-    db.commit()
-    db.clear_cache()
-
-
-def get_users(db):
-    rows = db.raw_query("SELECT * FROM users")
-    users = []
-    for row in rows:
-        uid = row[0]
-        user_name = row[1]
-        # Extract type from uid
-        type = uid.split("@")[1] if "@" in uid else row[7]
-        user = User(user_name, type)
-        user.load_from_inline(
-            row[0],
-            row[1],
-            row[3],
-            row[2],
-            row[4],
-            row[5],
-            row[6],
-            row[7],
-            row[8],
-            row[9],
+                media.save_to_db(batch)
+                if utils.thumbnail_worker and media_kind(media_file) in (
+                    "image",
+                    "video",
+                ):
+                    utils.thumbnail_worker.add(
+                        media.uid, os.path.join(fs_base, user_name, media_file)
+                    )
+        db.update_scan_manifest(
+            f"{user_name}@{type}", "media", dir_mtime, manifest_files
+        )
+        batch.flush()
+
+
+def get_changed_files(type, db, user_name, kind, file_filter, quick=True):
+    """
+    Compare a user directory against its scan manifest.
+    :param kind: "posts" or "media", each scanner keeps its own manifest
+    :param file_filter: callable picking the file names the scanner cares about
+    :param quick: skip the directory without listing it if its mtime is unchanged
+
+    :return: None if nothing changed, otherwise a tuple of
+        (dir mtime, changed file names, {file name: mtime} for the new manifest,
+        whether the directory was scanned before)
+    """
+    user_dir = os.path.join(config.fs_bases[type], user_name)
+    if user_name.startswith(".") or not os.path.isdir(user_dir):
+        return None
+    dir_mtime = os.stat(user_dir).st_mtime
+    manifest = None
+    if not full_scan_mode:
+        manifest = db.get_scan_manifest(f"{user_name}@{type}", kind)
+    if manifest and quick and manifest[0] == dir_mtime:
+        return None
+    old_files = manifest[2] if manifest else dict()
+    files = dict()
+    with os.scandir(user_dir) as entries:
+        for entry in entries:
+            if file_filter(entry.name) and entry.is_file():
+                files[entry.name] = entry.stat().st_mtime
+    changed = [f for f, mtime in files.items() if old_files.get(f) != mtime]
+    if manifest and not changed and manifest[0] == dir_mtime:
+        return None
+    return dir_mtime, changed, files, bool(manifest)
+
+
+def user_from_row(row):
+    """User from a users row, with the raw description as the user list shows it."""
+    uid = row[0]
+    user_name = row[1]
+    # Extract type from uid
+    type = uid.split("@")[1] if "@" in uid else row[7]
+    user = User(user_name, type)
+    user.load_from_inline(
+        row[0],
+        row[1],
+        row[3],
+        row[2],
+        row[4],
+        row[5],
+        row[6],
+        row[7],
+        row[8],
+        row[9],
+    )
+    return user
+
+
+class UserIndex:
+    """
+    All users, newest update first, searchable by substring of nick, uid,
+    user name or description. Kept up to date one user at a time, see
+    update(). The lower-cased search keys are joined into one string that
+    search() scans with str.find, which is far smaller than a trigram index
+    over descriptions and fast enough for 50k+ users.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = dict()
+        # lower-cased fields matched by search(), joined with "\0"
+        self.search_keys = dict()
+        # sort keys and uids in list order, (-update_time, rowid)
+        self.keys = dict()
+        self.order = []
+        self.order_uids = []
+        # search keys in list order and where each starts, rebuilt by
+        # search() after the index changed
+        self.haystack = None
+        self.starts = array("Q")
+
+    def __len__(self):
+        return len(self.order_uids)
+
+    def load(self, db: Database):
+        """Rebuild the whole index from the users table."""
+        # already in list order, so add() only appends
+        rows = db.raw_query(
+            "SELECT rowid, * FROM users ORDER BY update_time DESC, rowid",
+            ignore_cache=True,
         )
-        users.append(user)
-    users.sort(key=lambda u: u.update_time, reverse=True)
+        index = UserIndex()
+        for row in rows:
+            index.add(row)
+        with self.lock:
+            index.lock = self.lock
+            self.__dict__.update(index.__dict__)
+
+    def update(self, db: Database, uid):
+        """Reload one user, after it was added, changed or deleted."""
+        rows = db.raw_query(
+            ("SELECT rowid, * FROM users WHERE uid = ?", (uid,)), ignore_cache=True
+        )
+        with self.lock:
+            self.remove(uid)
+            if rows:
+                self.add(rows[0])
+
+    def add(self, row):
+        user = user_from_row(row[1:])
+        uid = user.uid
+        key = (-(user.update_time or 0), row[0])
+        pos = bisect.bisect(self.order, key)
+        self.order.insert(pos, key)
+        self.order_uids.insert(pos, uid)
+        self.keys[uid] = key
+        self.users[uid] = user
+        self.search_keys[uid] = "\0".join(
+            (x or "").lower()
+            for x in (user.nick, user.uid, user.user_name, user.description)
+        )
+        self.haystack = None
+
+    def remove(self, uid):
+        if uid not in self.users:
+            return
+        pos = bisect.bisect_left(self.order, self.keys.pop(uid))
+        del self.order[pos]
+        del self.order_uids[pos]
+        del self.users[uid]
+        del self.search_keys[uid]
+        self.haystack = None
+
+    def page(self, start, stop):
+        with self.lock:
+            return [self.users[uid] for uid in self.order_uids[start:stop]]
+
+    def all(self):
+        return self.page(0, None)
+
+    def get(self, uids):
+        """Users of uids that are in the index, in the same order."""
+        with self.lock:
+            return [self.users[uid] for uid in uids if uid in self.users]
+
+    def search(self, query):
+        """
+        :param query: lower-cased substring
+        :return: matching users, newest update first
+        """
+        if "\0" in query:
+            return []
+        with self.lock:
+            if self.haystack is None:
+                keys = [self.search_keys[uid] for uid in self.order_uids]
+                self.starts = array("Q")
+                pos = 0
+                for key in keys:
+                    self.starts.append(pos)
+                    pos += len(key) + 1
+                self.haystack = "\0".join(keys)
+            haystack, starts = self.haystack, self.starts
+            res = []
+            i = haystack.find(query)
+            while i != -1:
+                n = bisect.bisect(starts, i) - 1
+                res.append(self.users[self.order_uids[n]])
+                # continue from the next user, each one is listed once
+                if n + 1 == len(starts):
+                    break
+                i = haystack.find(query, starts[n + 1])
+            return res
+
+
+def hydrate_users(db: Database, uids):
+    """
+    Load users by uid in one query.
+    :return: dict of uid -> User
+    """
+    users = dict()
+    for row in db.query_in("users", "uid", set(uids)):
+        type = row[0].rsplit("@", 1)[1] if "@" in row[0] else row[7]
+        user = User(row[1], type)
+        if user.load_from_row(row):
+            users[row[0]] = user
     return users
 
 
+def fav_post_ids(db: Database, post_ids):
+    """
+    Which of post_ids are favorites. Kept apart from the post queries, so
+    toggling a favorite doesn't invalidate their cached results.
+    :return: set of post IDs
+    """
+    rows = db.query_in("favdb.fav", "post_id", set(post_ids), columns="post_id")
+    return {row[0] for row in rows}
+
+
+def hydrate_videos(db: Database, media_ids):
+    """
+    Load what the shorts player shows for each video, post, fav flag and
+    author included, in one joined query.
+    :param media_ids: videos to load, ones without a post in the database are skipped
+    :return: dict of media_id -> tuple of (file_name, Post, author nick)
+    """
+    videos = dict()
+    for row in db.query_in(
+        "media",
+        "media.media_id",
+        dict.fromkeys(media_ids),
+        columns="posts.*, users.nick, users.user_name, media.media_id, media.file_name",
+        join="""JOIN posts ON posts.post_id = media.post_id
+        LEFT JOIN users ON users.uid = posts.uid""",
+    ):
+        post = Post(row[0], None, None)
+        post.load_from_row(row)
+        nick, user_name, media_id, file_name = row[-4:]
+        # same fallbacks as User.load_from_row()
+        author = (nick or user_name) if user_name is not None else ""
+        videos[media_id] = (file_name, post, author)
+    favs = fav_post_ids(db, [video[1].post_id for video in videos.values()])
+    for _, post, _ in videos.values():
+        post.fav = post.post_id in favs
+    return videos
+
+
+def hydrate_posts(db: Database, post_ids):
+    """
+    Load a page of posts together with their fav flags, media, users and
+    embeds, using a few IN queries instead of several queries per post.
+    :param post_ids: post IDs to load, IDs missing from the database are skipped
+    :return: tuple of (posts, media_entries, users)
+        posts: dict of post_id -> Post
+        media_entries: dict of post_id -> list of Media sorted by media_id
+        users: dict of user_name -> User, one for every loaded post
+    """
+    posts = dict()
+    for row in db.query_in("posts", "post_id", dict.fromkeys(post_ids)):
+        post = Post(row[0], None, None)
+        post.load_from_row(row)
+        posts[post.post_id] = post
+    favs = fav_post_ids(db, posts)
+    for post in posts.values():
+        post.fav = post.post_id in favs
+
+    embeds = dict()
+    for post in posts.values():
+        target = post.embed_target()
+        if target:
+            embeds[post.post_id] = target
+    embed_users = dict()
+    for row in db.query_in("users", "udid", set(i[0] for i in embeds.values())):
+        embed_users.setdefault(row[2], row)
+    embed_posts = dict()
+    for row in db.query_in("posts", "post_id", set(i[1] for i in embeds.values())):
+        embed_posts[row[0]] = row
+
+    media_rows = dict()
+    for row in db.query_in("media", "post_id", list(posts) + list(embed_posts)):
+        media_rows.setdefault(row[1], []).append(row)
+
+    for post_id, (embed_udid, embed_post_id) in embeds.items():
+        embed = Embed(embed_post_id, embed_udid, posts[post_id].type)
+        user_row = embed_users.get(embed_udid)
+        embed.load_from_rows(
+            user_row,
+            embed_posts.get(embed_post_id) if user_row else None,
+            media_rows.get(embed_post_id, []),
+        )
+        posts[post_id].embed_obj = embed
+
+    media_entries = dict()
+    for post_id, post in posts.items():
+        if post_id not in media_rows:
+            continue
+        entries = []
+        for row in media_rows[post_id]:
+            media = Media(row[0], post_id, post.user_name, post.type, post.time)
+            media.load_from_row(row)
+            entries.append(media)
+        media_entries[post_id] = natsort.natsorted(entries, key=lambda x: x.media_id)
+
+    found = hydrate_users(db, [post.uid for post in posts.values() if post.uid])
+    users = dict()
+    for post in posts.values():
+        if post.user_name not in users:
+            users[post.user_name] = found.get(post.uid) or User(
+                post.user_name, post.type
+            )
+    return posts, media_entries, users
+
+
+def rerender_html(db: Database, batch_size=500):
+    """
+    Re-render stored HTML written by an older utils.render_version, or not
+    at all yet, in the background. Page loads fall back to rendering those
+    rows themselves until this catches up.
+    """
+    for table, text_col, html_col in (
+        ("posts", "text_content", "text_html"),
+        ("users", "description", "description_html"),
+    ):
+        last_rowid = 0
+        rendered = 0
+        while utils.global_running_flag:
+            rows = db.raw_query(
+                (
+                    f"SELECT rowid, type, {text_col} FROM {table} "
+                    "WHERE rowid > ? AND html_ver IS NOT ? ORDER BY rowid LIMIT ?",
+                    (last_rowid, utils.render_version, batch_size),
+                ),
+                ignore_cache=True,
+            )
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+            with db.db_lock:
+                db.pending_tags.add(table)
+                cursor = db.conn.cursor()
+                cursor.executemany(
+                    f"UPDATE {table} SET {html_col} = ?, html_ver = ? WHERE rowid = ?",
+                    [
+                        (utils.embed_hyperlink(row[1], row[2]), utils.render_version, row[0])
+                        for row in rows
+                    ],
+                )
+                cursor.close()
+            db.commit()
+            rendered += len(rows)
+        if rendered:
+            logger.log(f"Rendered HTML for {rendered} {table}.")
+
+
+def backfill_media_bytes(db: Database, batch_size=500):
+    """
+    Fill in media.bytes of rows ingested before it existed in the
+    background, and recount user_stats of their users.
+    """
+    last_rowid = 0
+    filled = 0
+    while utils.global_running_flag:
+        rows = db.raw_query(
+            (
+                "SELECT rowid, uid, type, file_name FROM media "
+                "WHERE rowid > ? AND bytes IS NULL ORDER BY rowid LIMIT ?",
+                (last_rowid, batch_size),
+            ),
+            ignore_cache=True,
+        )
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+        with db.db_lock:
+            cursor = db.conn.cursor()
+            # 0 for missing files, so they aren't looked up again
+            cursor.executemany(
+                "UPDATE media SET bytes = ? WHERE rowid = ?",
+                [(media_file_size(*row[1:]) or 0, row[0]) for row in rows],
+            )
+            cursor.close()
+        db.refresh_user_stats({row[1] for row in rows})
+        db.commit()
+        filled += len(rows)
+    if filled:
+        logger.log(f"Filled in file sizes of {filled} media.")
+
+
+user_sorts = {
+    "posts": "post_count",
+    "media": "media_count",
+    "videos": "video_count",
+    "size": "bytes",
+    "newest": "newest_ts",
+}
+
+
+def load_user_stats(db: Database, users):
+    """Fill in the user_stats numbers of a page of users."""
+    rows = {
+        row[0]: row[1:]
+        for row in db.query_in("user_stats", "uid", [user.uid for user in users])
+    }
+    for user in users:
+        if user.uid in rows:
+            user.load_stats(rows[user.uid])
+
+
+def sorted_user_ids(db: Database, sort):
+    """
+    :param sort: one of user_sorts
+    :return: uids of all users, largest first, ties by update time
+    """
+    column = user_sorts[sort]
+    rows = db.raw_query(
+        f"""SELECT users.uid FROM users
+        LEFT JOIN user_stats ON user_stats.uid = users.uid
+        ORDER BY user_stats.{column} DESC, users.update_time DESC, users.rowid"""
+    )
+    return [row[0] for row in rows]
+
+
 def flag_user(db: Database, user_name, type):
     uid = f"{user_name}@{type}"
     # logger.log(f"*********Flagging user {uid}")
     # logger.log(f"UPDATE users SET flagged = 1 WHERE uid = \"{uid}\"")
-    db.raw_query(f'UPDATE users SET flagged = 1 WHERE uid = "{uid}"', "main", True)
+    db.execute(
+        "UPDATE users SET flagged = 1 WHERE uid = ?",
+        (uid,),
+        tags=("users", f"users:{uid}"),
+    )
     db.commit()
+    user_index.update(db, uid)
 
 
-all_users = []
-cache_all_posts_id = []
-cache_all_posts_id_top = []
-cache_all_posts_id_random = []
-cache_all_media_id = []
-cache_user_media_id = dict()
-query_cache = dict()
-cache_query_media_id = dict()
+user_index = UserIndex()
+# replaced as a whole, never modified in place, see TimelineSnapshot
+timeline = TimelineSnapshot()
+snapshot_lock = threading.Lock()
+query_cache = LRUCache(
+    config.query_cache_entries, config.query_cache_size_mb * 1024 * 1024
+)
 
 
 valid_video_types = set(("mp4", "webm", "m4v"))
@@ -1061,62 +2581,220 @@ valid_media_types = (
     .union(valid_attachment_types)
 )
 
+media_kinds = (
+    ("video", valid_video_types),
+    ("audio", valid_audio_types),
+    ("image", valid_image_types),
+    ("flash", valid_flash_types),
+    ("attachment", valid_attachment_types),
+)
+
+
+def media_kind(file_name):
+    """Kind of a media file from its extension, stored in media.kind."""
+    ext = file_name.split(".")[-1].lower() if file_name else ""
+    for kind, exts in media_kinds:
+        if ext in exts:
+            return kind
+    return ""
+
 
 def build_cache(db: Database):
-    global cache_all_posts_id, cache_all_media_id, cache_user_media_id, cache_all_posts_id_top, cache_all_posts_id_random, query_cache
-
-    # debug, skip cache building
-    # if debug_mode:
-    #     return
-
-    rows = db.raw_query("SELECT post_id,type,time,likes FROM posts")
-    cache_all_posts_id = []
-    for row in rows:
-        post_id = row[0]
-        post_time = row[2]
-        cache_all_posts_id.append((post_id, post_time))
-    cache_all_posts_id = natsort.natsorted(
-        cache_all_posts_id, key=lambda p: p[1], reverse=True
+    """
+    Rebuild the timeline caches into a new snapshot and swap it in. Pages
+    keep being served from the old one in the meantime. Nothing is rebuilt
+    if the snapshot on disk is still up to date with the database.
+    """
+    global timeline
+
+    # held throughout, a merge_timeline() running alongside would be lost
+    # when this snapshot replaces the one it merged into
+    with snapshot_lock:
+        # read first, changes made during the build make the saved copy stale
+        generation = db.get_meta("generation")
+        db_id = db.get_meta("db_id")
+        if timeline.generation == generation:
+            return
+        snapshot = load_timeline(db_id)
+        if snapshot and snapshot.generation == generation:
+            logger.log("Timeline snapshot is up to date.")
+            timeline = snapshot
+            return
+        snapshot = TimelineSnapshot()
+        snapshot.generation = generation
+        # rows are streamed straight into the packed tables, so the full
+        # list of row tuples never exists in memory
+        cursor = db.read_conn().cursor()
+        cursor.execute("SELECT post_id, ts, likes FROM posts ORDER BY ts DESC")
+        for row in cursor:
+            snapshot.add_post(*row)
+        cursor.execute(
+            "SELECT media_id, ts FROM media WHERE kind = 'video' ORDER BY ts DESC"
+        )
+        for row in cursor:
+            snapshot.add_video(*row)
+        cursor.close()
+        snapshot.sort()
+        timeline = snapshot
+        try:
+            save_timeline(snapshot, db_id)
+        except OSError as e:
+            logger.log(f"Could not save timeline snapshot: {e}", type="error")
+
+
+def load_saved_timeline(db: Database):
+    """
+    Serve the snapshot from the last run right away at startup, even if
+    it's stale, build_cache() replaces it once it has caught up.
+    """
+    global timeline
+
+    snapshot = load_timeline(db.get_meta("db_id"))
+    if snapshot:
+        with snapshot_lock:
+            timeline = snapshot
+        logger.log(f"Loaded timeline snapshot with {len(snapshot.post_ids)} posts.")
+
+
+def merge_timeline(db: Database, uid):
+    """
+    Add a user's new posts and videos to the timeline caches after a
+    single-user scan, without rebuilding them.
+    """
+    global timeline
+
+    post_rows = db.raw_query(
+        ("SELECT post_id, ts, likes FROM posts WHERE uid = ?", (uid,)),
+        ignore_cache=True,
+    )
+    video_rows = db.raw_query(
+        ("SELECT media_id, ts FROM media WHERE uid = ? AND kind = 'video'", (uid,)),
+        ignore_cache=True,
+    )
+    with snapshot_lock:
+        snapshot = timeline.copy()
+        # no longer matches any database generation
+        snapshot.generation = None
+        added = snapshot.merge_posts(post_rows)
+        added += snapshot.merge_videos(video_rows)
+        if added:
+            timeline = snapshot
+    if added:
+        logger.log(f"Merged {added} new posts and videos of {uid} into the timeline.")
+
+
+def get_user_videos(db: Database, uid):
+    """
+    Media IDs of a user's videos, newest first, read through the partial
+    video index and packed into an IdTable. Kept in query_cache until the
+    user's media change.
+    """
+    key = ("user_videos", uid)
+    videos = query_cache.get(key)
+    if videos is not None:
+        return videos
+    generation = query_cache.generation
+    videos = IdTable()
+    cursor = db.read_conn().cursor()
+    cursor.execute(
+        "SELECT media_id FROM media WHERE uid = ? AND kind = 'video' ORDER BY ts DESC, media_id DESC",
+        (uid,),
     )
-    cache_all_posts_id_top = []
-    for row in rows:
-        post_id = row[0]
-        post_likes = row[3]
-        cache_all_posts_id_top.append((post_id, post_likes))
-    cache_all_posts_id_top = natsort.natsorted(
-        cache_all_posts_id_top, key=lambda p: p[1], reverse=True
+    for row in cursor:
+        videos.append(row[0])
+    cursor.close()
+    query_cache.put(
+        key,
+        videos,
+        (f"media:{uid}",),
+        size=len(videos.blob) + videos.offsets.itemsize * len(videos.offsets),
+        generation=generation,
     )
-    cache_all_posts_id_random = list(cache_all_posts_id)
-    random.shuffle(cache_all_posts_id_random)
-    # get media that ends with .mp4
+    return videos
+
+
+def get_fav_page(db: Database, page, per_page):
+    """
+    :return: post IDs of a page of favorites, most recently added first
+    """
     rows = db.raw_query(
-        "SELECT media_id FROM media WHERE file_name LIKE '%.mp4' OR file_name LIKE '%.webm' OR file_name LIKE '%.m4v'"
+        (
+            "SELECT post_id FROM favdb.fav WHERE post_id != '' ORDER BY rowid DESC LIMIT ? OFFSET ?",
+            (per_page, page * per_page),
+        )
     )
-    cache_all_media_id = []
-    for row in rows:
-        cache_all_media_id.append(row[0])
-    random.shuffle(cache_all_media_id)
-    cache_user_media_id = dict()
-    query_cache = dict()
+    return [row[0] for row in rows]
+
+
+def count_fav(db: Database):
+    return db.raw_query("SELECT COUNT(*) FROM favdb.fav WHERE post_id != ''")[0][0]
+
 
+# media of favorited posts, most recently added first
+fav_media_from = """favdb.fav AS fav
+    JOIN posts ON posts.post_id = fav.post_id
+    JOIN media ON media.post_id = fav.post_id"""
 
-def get_fav(db: Database):
-    return db.query_rows(selected_db="fav", key="", value="", ignore_cache=True)
+
+def get_fav_media_page(db: Database, page, per_page):
+    """
+    :return: media rows of a page of the favorites media tab
+    """
+    return db.raw_query(
+        (
+            f"SELECT media.* FROM {fav_media_from} ORDER BY fav.rowid DESC, media.rowid LIMIT ? OFFSET ?",
+            (per_page, page * per_page),
+        )
+    )
+
+
+def count_fav_media(db: Database):
+    return db.raw_query(f"SELECT COUNT(*) FROM {fav_media_from}")[0][0]
+
+
+def parse_fav_time(fav_time):
+    """fav_time, e.g. "Wed Jun  4 19:01:32 2025", as epoch seconds, 0 if it's invalid."""
+    try:
+        return int(time.mktime(time.strptime(fav_time, "%a %b %d %H:%M:%S %Y")))
+    except (TypeError, ValueError, OverflowError):
+        return 0
+
+
+def iter_fav_files(db: Database, since=None):
+    """
+    Files of favorited posts, oldest favorite first, streamed from one join.
+    :param since: only favorites added after this epoch time
+    :return: generator of (path, fav_ts)
+    """
+    sql = """SELECT fav.fav_ts, posts.uid, posts.type, media.file_name
+    FROM favdb.fav AS fav
+    JOIN posts ON posts.post_id = fav.post_id
+    JOIN media ON media.post_id = fav.post_id"""
+    params = ()
+    if since is not None:
+        sql += " WHERE fav.fav_ts > ?"
+        params = (since,)
+    sql += " ORDER BY fav.rowid, media.rowid"
+    for fav_ts, uid, type, file_name in db.iter_query(sql, params):
+        user_name = uid.rsplit("@", 1)[0] if uid else None
+        yield os.path.join(config.fs_bases[type], user_name, file_name), fav_ts
 
 
 def add_favorite(db: Database, post_id):
     if not db.query_rows("posts", "post_id", post_id):
         return
-    db.raw_query(
-        f"INSERT OR REPLACE INTO fav VALUES ('{post_id}', '{time.ctime()}')",
+    now = time.time()
+    db.execute(
+        "INSERT OR REPLACE INTO fav (post_id, fav_time, fav_ts) VALUES (?, ?, ?)",
+        (post_id, time.ctime(now), int(now)),
         "fav",
-        True,
+        ("fav",),
     )
     db.commit()
 
 
 def remove_favorite(db: Database, post_id):
-    db.raw_query(f"DELETE FROM fav WHERE post_id = '{post_id}'", "fav", True)
+    db.execute("DELETE FROM fav WHERE post_id = ?", (post_id,), "fav", ("fav",))
     db.commit()
 
 
@@ -15,10 +15,40 @@ fs_bases = {
 
 cache_path = "~/.cache/mt"
 thubnail_size = 600
+# requested thumbnail sizes are rounded up to one of these
+thumbnail_size_buckets = [160, 320, 600, 1000, 1600, 2500]
+# thumbnail formats in the order of preference, each is served to clients
+# that accept it, formats the installed Pillow can't write are skipped
+thumbnail_formats = ["avif", "webp", "jpeg"]
+# Pillow save options of each format, "method" (0-6) is webp's effort,
+# "speed" (0-10, lower is slower and smaller) is avif's
+thumbnail_encode = {
+    "jpeg": {"quality": 75},
+    "webp": {"quality": 75, "method": 4},
+    "avif": {"quality": 60, "speed": 6},
+}
+# disk budgets of the thumbnail cache and of tmp/.cached (proxied images)
+thumbnail_cache_size_mb = 2048
+proxy_cache_size_mb = 256
+# threads creating thumbnails ahead of requests, and how many can be queued
+thumbnail_workers = 2
+thumbnail_queue_size = 10000
+# ffmpeg processes allowed at once, and seconds before one is killed
+ffmpeg_workers = 2
+ffmpeg_timeout = 30
 
 custom_gallery_dl_location = "" #~/venv/bin/gallery-dl
 
 items_per_page = 30
+# ancestors shown above a reply, longer threads are cut off at the top
+reply_chain_max_depth = 20
+# query result cache, whichever limit is hit first evicts
+query_cache_entries = 5000
+query_cache_size_mb = 256
+# rows buffered by the scanners before they are written in one transaction
+ingest_batch_size = 1000
+# processes used to parse metadata files on large scans, 0 = number of cores
+ingest_workers = 0
 proxy = None
 # proxy = "http://127.0.0.1:7890" # uncomment to use proxy
 
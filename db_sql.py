@@ -0,0 +1,18 @@
+# SQL shared by backend and db_tools, kept free of imports so that db_tools
+# can use it without loading the app
+
+# recounts user_stats of the uids selected by {uids}, a query or VALUES list
+user_stats_sql = """WITH u(uid) AS ({uids})
+INSERT OR REPLACE INTO user_stats SELECT uid,
+    (SELECT COUNT(*) FROM posts WHERE posts.uid = u.uid),
+    (SELECT COUNT(*) FROM media WHERE media.uid = u.uid),
+    (SELECT COUNT(*) FROM media WHERE media.uid = u.uid AND kind = 'video'),
+    (SELECT IFNULL(SUM(bytes), 0) FROM media WHERE media.uid = u.uid),
+    (SELECT MAX(ts) FROM posts WHERE posts.uid = u.uid)
+FROM u WHERE uid IS NOT NULL"""
+all_user_stats_sql = user_stats_sql.format(
+    uids="SELECT uid FROM posts UNION SELECT uid FROM media"
+)
+# the timeline caches are rebuilt when the generation they were built from
+# changes, run by every commit that changes posts or media rows
+bump_generation_sql = "UPDATE meta SET value = value + 1 WHERE key = 'generation'"
@@ -2,6 +2,7 @@
 
 import config
 import os, re, sqlite3, shutil, time
+from db_sql import all_user_stats_sql, bump_generation_sql
 
 config.fs_bases["x"] = os.path.expanduser(config.fs_bases["x"])
 config.fs_bases["bsky"] = os.path.expanduser(config.fs_bases["bsky"])
@@ -166,6 +167,8 @@ def remove_user():
         sql1 = f'DELETE FROM posts WHERE uid = "{uid}"'
         sql2 = f'DELETE FROM media WHERE uid = "{uid}"'
         sql3 = f'DELETE FROM users WHERE uid = "{uid}"'
+        # or a rescan of the directory would skip the unchanged files
+        sql4 = f'DELETE FROM scan_manifest WHERE uid = "{uid}"'
         # if input(f"{sql1}\n{sql2}\n{sql3}\nSure?[y/n]>>") == "y":
         if 1:
             conn = sqlite3.connect(sqlite_file)
@@ -173,9 +176,38 @@ def remove_user():
             cursor.execute(sql1)
             cursor.execute(sql2)
             cursor.execute(sql3)
+            cursor.execute(sql4)
+            bump_generation(cursor)
             conn.commit()
             conn.close()
     missing_users = set()
+    refresh_user_stats()
+
+
+def has_table(cursor, name):
+    return cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone() is not None
+
+
+def bump_generation(cursor):
+    # tells the app its timeline caches are stale, call after changing posts or media
+    if has_table(cursor, "meta"):
+        cursor.execute(bump_generation_sql)
+
+
+def refresh_user_stats():
+    print("Recounting posts and media of every user.")
+    conn = sqlite3.connect(sqlite_file)
+    cursor = conn.cursor()
+    if not has_table(cursor, "user_stats"):
+        print("No user_stats table yet, the app creates and fills it on its next start.")
+        conn.close()
+        return
+    cursor.execute("DELETE FROM user_stats")
+    cursor.execute(all_user_stats_sql)
+    conn.commit()
+    conn.close()
 
 
 def rn_user(id_, to_id_):
@@ -200,7 +232,8 @@ def rn_user(id_, to_id_):
             return
         # move os.path.join(config.fs_bases[type_],old_user_name) to os.path.join(config.fs_bases[type_],new_user_name)
         # if os.path.join(config.fs_bases[type_],new_user_name) exists, move all files in os.path.join(config.fs_bases[type_],old_user_name) to os.path.join(config.fs_bases[type_],new_user_name)
-        if os.path.exists(os.path.join(config.fs_bases[type_], new_user_name)):
+        merged = os.path.exists(os.path.join(config.fs_bases[type_], new_user_name))
+        if merged:
             for file in os.listdir(os.path.join(config.fs_bases[type_], old_user_name)):
                 # skip exsisitng files
                 if os.path.exists(os.path.join(config.fs_bases[type_], new_user_name, file)):
@@ -242,14 +275,29 @@ def rn_user(id_, to_id_):
                 cursor.execute(f'DELETE FROM users WHERE uid = "{id_}"')
                 print("Done.")
             pass
+        # the scan manifest of a moved directory is still valid, a merged
+        # directory matches neither, so it gets scanned again in full
+        try:
+            cursor.execute(f'DELETE FROM scan_manifest WHERE uid = "{to_id_}"')
+            if merged:
+                cursor.execute(f'DELETE FROM scan_manifest WHERE uid = "{id_}"')
+            else:
+                cursor.execute(
+                    f'UPDATE scan_manifest SET uid = "{to_id_}" WHERE uid = "{id_}"'
+                )
+        except Exception as e:
+            print(e)
+            pass
         # set flagged to 0 for the user
         try:
             cursor.execute(f'UPDATE users SET flagged = 0 WHERE uid = "{to_id_}"')
         except Exception as e:
             print(e)
             pass
+        bump_generation(cursor)
         conn.commit()
         conn.close()
+        refresh_user_stats()
 
 
 def user_rename():
@@ -308,6 +356,9 @@ def sql_console():
                 print(e)
         except KeyboardInterrupt:
             break
+        # only statements that change rows open a transaction
+        if conn.in_transaction:
+            bump_generation(cursor)
         conn.commit()
     conn.close()
 
@@ -394,6 +445,7 @@ def remove_deleted_media():
             cursor.execute(
                 "DELETE FROM media WHERE media_id = ? AND type = ?", (media_id, type_)
             )
+    bump_generation(cursor)
     conn.commit()
     conn.close()
 
@@ -483,6 +535,7 @@ def delete_site():
     print(f"DELETE FROM posts WHERE type = \"{site}\"")
     print(f"DELETE FROM media WHERE type = \"{site}\"")
     print(f"DELETE FROM users WHERE type = \"{site}\"")
+    print(f"DELETE FROM scan_manifest WHERE uid LIKE \"%@{site}\"")
     if input("Confirm? [y/n] >>") != "y":
         print("Aborting.")
         return
@@ -492,8 +545,11 @@ def delete_site():
     cursor.execute(f'DELETE FROM posts WHERE type = "{site}"')
     cursor.execute(f'DELETE FROM media WHERE type = "{site}"')
     cursor.execute(f'DELETE FROM users WHERE type = "{site}"')
+    cursor.execute(f'DELETE FROM scan_manifest WHERE uid LIKE "%@{site}"')
+    bump_generation(cursor)
     conn.commit()
     conn.close()
+    refresh_user_stats()
 
 def fs_format_fix():
     print("Fix filesystem casing issues for user directories.")
@@ -522,7 +578,7 @@ def fs_format_fix():
 if __name__ == "__main__":
     while True:
         choice = input(
-            "[0] sanity_check()\n[1] remove_legacy_json()\n[2] drop_table_users()\n[3] remove_user()\n[4] user_rename()\n[5] sql_console()\n[6] external_vid_fix()\n[7] remove_deleted_media()\n[8] create_avatar_and_banner_backup()\n[9] remove_avatar_and_banner()\n[10] remove_empty_files()\n[11] delete_site()\n[12] fs_format_fix()\n >> "
+            "[0] sanity_check()\n[1] remove_legacy_json()\n[2] drop_table_users()\n[3] remove_user()\n[4] user_rename()\n[5] sql_console()\n[6] external_vid_fix()\n[7] remove_deleted_media()\n[8] create_avatar_and_banner_backup()\n[9] remove_avatar_and_banner()\n[10] remove_empty_files()\n[11] delete_site()\n[12] fs_format_fix()\n[13] refresh_user_stats()\n >> "
         )
         if choice == "0":
             sanity_check()
@@ -549,4 +605,6 @@ if __name__ == "__main__":
         elif choice == "11":
             delete_site()
         elif choice == "12":
-            fs_format_fix()
\ No newline at end of file
+            fs_format_fix()
+        elif choice == "13":
+            refresh_user_stats()
\ No newline at end of file
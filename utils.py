@@ -1,10 +1,14 @@
-from PIL import Image
+from PIL import Image, features
 import time, os, re, sys
+import calendar
 import traceback
 import subprocess
 import signal
+import sqlite3
 from hashlib import md5
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition, Semaphore, get_ident
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import requests
 
 import config, backend, logger
@@ -15,8 +19,12 @@ global_running_flag = True
 download_jobs = []
 current_url = ""
 has_new_download = True
-
-busy_flag = False
+# started by app.py, see ThumbnailWorker
+thumbnail_worker = None
+# thumbnail path -> Future of the thread creating it, see create_thumbnail()
+thumbnail_inflight = {}
+thumbnail_inflight_lock = Lock()
+ffmpeg_slots = Semaphore(config.ffmpeg_workers)
 
 current_python = sys.executable
 if not current_python:
@@ -51,30 +59,92 @@ headers = {
 }
 
 
-def create_image_thumbnail(image_path, thumbnail_path, thumbnail_size):
-    image = Image.open(image_path)
-    image.thumbnail((thumbnail_size, thumbnail_size))
-    image.convert("RGB").save(thumbnail_path)
+def get_temp_path(path):
+    """Unique sibling of path to write to before os.replace() puts it in place."""
+    base, ext = os.path.splitext(path)
+    return f"{base}.{os.getpid()}-{get_ident()}.tmp{ext}"
+
+
+# thumbnail format -> file extension, mimetype
+thumbnail_formats = {
+    "jpeg": ("jpg", "image/jpeg"),
+    "webp": ("webp", "image/webp"),
+    "avif": ("avif", "image/avif"),
+}
+# formats the installed Pillow can write, in the order of preference
+supported_thumbnail_formats = [
+    fmt
+    for fmt in config.thumbnail_formats
+    if fmt in thumbnail_formats and (fmt == "jpeg" or features.check(fmt))
+] or ["jpeg"]
+
+
+def pick_thumbnail_format(accepted):
+    """
+    :param accepted: mimetypes the client named in its Accept header
+    :return: the preferred thumbnail format the client accepts, jpeg if none
+    """
+    for fmt in supported_thumbnail_formats:
+        if thumbnail_formats[fmt][1] in accepted:
+            return fmt
+    return "jpeg"
+
+
+def create_image_thumbnail(image_path, thumbnail_path, thumbnail_size, fmt="jpeg"):
+    temp_path = get_temp_path(thumbnail_path)
+    try:
+        with Image.open(image_path) as image:
+            image.thumbnail((thumbnail_size, thumbnail_size))
+            has_alpha = "A" in image.getbands() or "transparency" in image.info
+            image = image.convert("RGBA" if has_alpha and fmt != "jpeg" else "RGB")
+            image.save(temp_path, format=fmt.upper(), **config.thumbnail_encode.get(fmt, {}))
+        os.replace(temp_path, thumbnail_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
 
 def create_video_thumbnail(video_path, thumbnail_path):
+    temp_path = get_temp_path(thumbnail_path)
     cmd = [
         "ffmpeg",
+        "-y",
+        "-loglevel",
+        "error",
         "-i",
         video_path,
         "-ss",
         "00:00:00.000",
         "-vframes",
         "1",
-        thumbnail_path,
+        temp_path,
     ]
     cmd = [str(x) for x in cmd]
-    os.system(" ".join(cmd))
-    # if not os.path.exists(thumbnail_path):
-    #     # try again at 00:00:00.000
-    #     cmd[4] = "00:00:00.000"
-    #     if os.system(" ".join(cmd)):
-    #         logger.log("Failed to create video thumbnail for:", video_path)
+    with ffmpeg_slots:
+        try:
+            result = subprocess.run(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                timeout=config.ffmpeg_timeout,
+            )
+            if result.returncode:
+                logger.log(
+                    "Failed to create video thumbnail for:",
+                    video_path,
+                    result.stderr.decode(errors="replace").strip(),
+                    type="error",
+                )
+            elif os.path.exists(temp_path):
+                os.replace(temp_path, thumbnail_path)
+        except subprocess.TimeoutExpired:
+            logger.log("ffmpeg timed out on:", video_path, type="error")
+        except FileNotFoundError:
+            logger.log("ffmpeg not found, can't create video thumbnails.", type="error")
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
 
 
 def filter_ascii(text):
@@ -83,19 +153,202 @@ def filter_ascii(text):
     return "".join(c for c in text if ord(c) < 128)
 
 
-def create_thumbnail(path, thumbnail_size=config.thubnail_size):
-    config.cache_path = os.path.expanduser(config.cache_path)
-    if not os.path.exists(config.cache_path):
-        os.makedirs(config.cache_path)
-    thumbnail_path = md5(path.encode()).hexdigest() + f"_{thumbnail_size}.jpg"
-    thumbnail_path = os.path.join(config.cache_path, thumbnail_path)
+class DiskCache(Thread):
+    """
+    Directory of cached files kept under a byte budget, least recently used
+    files are evicted first. A file is stored under its key, which must be a
+    plain file name, in a subdirectory picked by the key's hash. Access times
+    are collected in memory by touch() and written to a small sqlite index by
+    the thread, which also does the eviction.
+    :param adopt_pattern: regex of the file names in root that belong to the
+        cache, they are moved into it when the index is first built
+    """
+
+    index_name = ".index.db"
+
+    def __init__(self, root, max_bytes, adopt_pattern=None, interval=30):
+        super().__init__(daemon=True)
+        self.root = os.path.expanduser(root)
+        self.max_bytes = max_bytes
+        self.adopt_pattern = re.compile(adopt_pattern or ".+")
+        self.interval = interval
+        self.lock = Lock()
+        # key -> last access time, not in the index yet
+        self.accessed = dict()
+        self.total_bytes = 0
+        self.evicted = 0
+
+    def path(self, key):
+        return os.path.join(self.root, md5(key.encode()).hexdigest()[:2], key)
+
+    def touch(self, key):
+        """Record an access to key, call after the file was used or written."""
+        with self.lock:
+            self.accessed[key] = time.time()
+
+    def get(self, key):
+        """
+        :return: path of the cached file, None if it isn't cached
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        self.touch(key)
+        return path
+
+    def run(self):
+        os.makedirs(self.root, exist_ok=True)
+        index_path = os.path.join(self.root, self.index_name)
+        is_new = not os.path.exists(index_path)
+        conn = sqlite3.connect(index_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, atime REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_atime ON entries(atime)")
+        if is_new:
+            self.adopt(conn)
+        while global_running_flag:
+            try:
+                self.flush(conn)
+                if self.total_bytes > self.max_bytes:
+                    self.evict(conn)
+            except Exception as e:
+                logger.log(traceback.format_exc(), type="error")
+            time.sleep(self.interval)
+        conn.close()
+
+    def adopt(self, conn):
+        """Put the files already in the directory in a new index, moving them to their subdirectory."""
+        logger.log("Indexing cache directory:", self.root)
+        for name in os.listdir(self.root):
+            src = os.path.join(self.root, name)
+            if name.startswith(".") or ".tmp" in name or not os.path.isfile(src):
+                continue
+            if not self.adopt_pattern.fullmatch(name):
+                continue
+            dst = self.path(name)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.replace(src, dst)
+        for shard in os.listdir(self.root):
+            if not re.fullmatch("[0-9a-f]{2}", shard):
+                continue
+            for name in os.listdir(os.path.join(self.root, shard)):
+                if ".tmp" not in name:
+                    self.touch(name)
+
+    def flush(self, conn):
+        with self.lock:
+            accessed, self.accessed = self.accessed, dict()
+        rows = []
+        gone = []
+        for key, atime in accessed.items():
+            try:
+                rows.append((key, os.path.getsize(self.path(key)), atime))
+            except OSError:
+                gone.append((key,))
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO entries VALUES (?,?,?)", rows)
+            conn.executemany("DELETE FROM entries WHERE key = ?", gone)
+        self.total_bytes = conn.execute(
+            "SELECT IFNULL(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+
+    def evict(self, conn):
+        """Remove the least recently used files until the cache is at 90% of its budget."""
+        target = self.max_bytes * 0.9
+        evicted = 0
+        while self.total_bytes > target:
+            rows = conn.execute(
+                "SELECT key, size FROM entries ORDER BY atime LIMIT 500"
+            ).fetchall()
+            if not rows:
+                break
+            removed = []
+            for key, size in rows:
+                if self.total_bytes <= target:
+                    break
+                try:
+                    os.remove(self.path(key))
+                except FileNotFoundError:
+                    pass
+                removed.append((key,))
+                self.total_bytes -= size
+            with conn:
+                conn.executemany("DELETE FROM entries WHERE key = ?", removed)
+            evicted += len(removed)
+        self.evicted += evicted
+        logger.log(f"Evicted {evicted} files from {self.root}.", verbose=1)
+
+    def stats(self):
+        return {
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "evicted": self.evicted,
+        }
+
+
+thumbnail_cache = DiskCache(
+    config.cache_path,
+    config.thumbnail_cache_size_mb * 1024 * 1024,
+    adopt_pattern=r"[0-9a-f]{32}_\d+\.\w+",
+)
+proxy_cache = DiskCache("tmp/.cached", config.proxy_cache_size_mb * 1024 * 1024)
+
+
+def snap_thumbnail_size(size):
+    """Round a requested thumbnail size up to one of config.thumbnail_size_buckets."""
+    return min(
+        (b for b in config.thumbnail_size_buckets if b >= size),
+        default=max(config.thumbnail_size_buckets),
+    )
+
+
+def get_thumbnail_path(path, thumbnail_size=config.thubnail_size, fmt="jpeg"):
+    return thumbnail_cache.path(get_thumbnail_key(path, thumbnail_size, fmt))
+
+
+def get_thumbnail_key(path, thumbnail_size=config.thubnail_size, fmt="jpeg"):
+    ext = thumbnail_formats[fmt][0]
+    return md5(path.encode()).hexdigest() + f"_{thumbnail_size}.{ext}"
+
+
+def create_thumbnail(path, thumbnail_size=config.thubnail_size, fmt="jpeg"):
+    """
+    :param fmt: key of thumbnail_formats, see pick_thumbnail_format()
+    :return: path of the thumbnail, which may not exist if creating it failed
+    """
+    thumbnail_key = get_thumbnail_key(path, thumbnail_size, fmt)
+    thumbnail_path = thumbnail_cache.path(thumbnail_key)
     if os.path.exists(thumbnail_path):
         # logger.log("Thumbnail exists:", thumbnail_path)
+        thumbnail_cache.touch(thumbnail_key)
         return thumbnail_path
+    os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+    # only one thread creates a given thumbnail, the others wait for it
+    with thumbnail_inflight_lock:
+        future = thumbnail_inflight.get(thumbnail_path)
+        owner = future is None
+        if owner:
+            future = thumbnail_inflight[thumbnail_path] = Future()
+    if not owner:
+        return future.result()
+    try:
+        if not os.path.exists(thumbnail_path):
+            _create_thumbnail(path, thumbnail_path, thumbnail_size, fmt)
+        thumbnail_cache.touch(thumbnail_key)
+        future.set_result(thumbnail_path)
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with thumbnail_inflight_lock:
+            del thumbnail_inflight[thumbnail_path]
+    return future.result()
+
+
+def _create_thumbnail(path, thumbnail_path, thumbnail_size, fmt):
     logger.log("Creating thumbnail:", thumbnail_path, verbose=1)
-    if path.split(".")[-1].lower() in ["mp4", "mov", "avi", "mkv", "webm", "m4v"]:
-        create_video_thumbnail(path, thumbnail_path)
-    elif path.split(".")[-1].lower() in [
+    if path.split(".")[-1].lower() in [
         "jpg",
         "jpeg",
         "png",
@@ -104,12 +357,140 @@ def create_thumbnail(path, thumbnail_size=config.thubnail_size):
         "tiff",
         "webp",
     ]:
-        create_image_thumbnail(path, thumbnail_path, thumbnail_size)
-    else:
+        create_image_thumbnail(path, thumbnail_path, thumbnail_size, fmt)
+        return
+    if path.split(".")[-1].lower() not in ["mp4", "mov", "avi", "mkv", "webm", "m4v"]:
         logger.log("Unsupported file type for thumbnail:", path)
         logger.log("Still trying to create thumbnail with video method.")
+    if fmt == "jpeg":
         create_video_thumbnail(path, thumbnail_path)
-    return thumbnail_path
+    else:
+        # ffmpeg writes the frame as jpeg, other formats are made from that
+        frame_path = create_thumbnail(path, thumbnail_size)
+        if os.path.exists(frame_path):
+            create_image_thumbnail(frame_path, thumbnail_path, thumbnail_size, fmt)
+
+
+class ThumbnailWorker(Thread):
+    """
+    Creates thumbnails at the default size and in the most preferred format
+    before they are requested, on a bounded thread pool. Threads share the
+    in-flight table and ffmpeg slots of create_thumbnail() with requests, so
+    neither does the work twice.
+    Fed by the media scanner and backfill(). Jobs are queued per user, users
+    viewed recently go first, see touch().
+    """
+
+    def __init__(self, workers=None, queue_size=None):
+        super().__init__(daemon=True)
+        self.workers = workers or config.thumbnail_workers
+        self.queue_size = queue_size or config.thumbnail_queue_size
+        # uid -> deque of media paths, users in the order they were queued
+        self.pending = OrderedDict()
+        self.queued = 0
+        # recently viewed uids, most recent last
+        self.recent = OrderedDict()
+        self.cond = Condition()
+        # jobs handed to the pool but not finished yet
+        self.slots = Semaphore(self.workers * 2)
+        self.created = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def add(self, uid, path, block=False):
+        """
+        Queue the thumbnail of a media file.
+        :param block: wait for room in the queue instead of dropping the job
+        :return: False if the job was dropped
+        """
+        with self.cond:
+            while self.queued >= self.queue_size:
+                if not block or not global_running_flag:
+                    self.dropped += 1
+                    return False
+                self.cond.wait(1)
+            self.pending.setdefault(uid, deque()).append(path)
+            self.queued += 1
+            self.cond.notify_all()
+        return True
+
+    def touch(self, uid):
+        """Move the queued thumbnails of a user that is being viewed to the front."""
+        with self.cond:
+            self.recent.pop(uid, None)
+            self.recent[uid] = True
+            if len(self.recent) > 100:
+                self.recent.popitem(last=False)
+
+    def pop(self):
+        """Next job, called with self.cond held and something queued."""
+        uid = next((u for u in reversed(self.recent) if u in self.pending), None)
+        if uid is None:
+            uid = next(iter(self.pending))
+        paths = self.pending[uid]
+        path = paths.popleft()
+        if not paths:
+            del self.pending[uid]
+        self.queued -= 1
+        self.cond.notify_all()
+        return path
+
+    def run(self):
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        while global_running_flag:
+            with self.cond:
+                if not self.queued:
+                    self.cond.wait(1)
+                    continue
+                path = self.pop()
+            fmt = supported_thumbnail_formats[0]
+            if os.path.exists(get_thumbnail_path(path, fmt=fmt)):
+                continue
+            self.slots.acquire()
+            try:
+                future = pool.submit(create_thumbnail, path, fmt=fmt)
+            except RuntimeError:
+                # the interpreter is exiting
+                break
+            future.add_done_callback(self.done)
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def done(self, future):
+        self.slots.release()
+        if future.cancelled():
+            return
+        if future.exception():
+            self.failed += 1
+            logger.log("Thumbnail failed:", future.exception(), type="error")
+        else:
+            self.created += 1
+
+    def backfill(self, db):
+        """Queue the missing thumbnails of every image and video, newest first."""
+        logger.log("Queueing missing thumbnails...")
+        queued = 0
+        for uid, type, file_name in db.iter_query(
+            "SELECT uid, type, file_name FROM media WHERE kind IN ('image', 'video') ORDER BY rowid DESC"
+        ):
+            if not global_running_flag:
+                return
+            path = backend.media_path(uid, type, file_name)
+            if not path or os.path.exists(
+                get_thumbnail_path(path, fmt=supported_thumbnail_formats[0])
+            ):
+                continue
+            self.add(uid, path, block=True)
+            queued += 1
+        logger.log(f"Queued {queued} missing thumbnails.")
+
+    def stats(self):
+        with self.cond:
+            return {
+                "queued": self.queued,
+                "created": self.created,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            }
 
 
 class DownloadWorker(Thread):
@@ -118,7 +499,7 @@ class DownloadWorker(Thread):
         self.db = db
 
     def run(self):
-        global download_jobs, global_lock, global_running_flag, current_url, has_new_download, busy_flag
+        global download_jobs, global_lock, global_running_flag, current_url, has_new_download
         while global_running_flag:
             try:
                 with global_lock:
@@ -247,17 +628,14 @@ class DownloadWorker(Thread):
                     ],
                 )
                 try:
-                    busy_flag = True
                     backend.scan_for_users(type, self.db, name)
                     backend.scan_for_posts(type, self.db, name)
                     backend.scan_for_media(type, self.db, name)
                     self.db.commit()
+                    backend.merge_timeline(self.db, f"{name}@{type}")
                     has_new_download = True
-                    backend.query_cache = dict()
                     logger.log(name, "downloaded")
-                    busy_flag = False
                 except Exception as e:
-                    busy_flag = False
                     logger.log(traceback.format_exc(), type="error")
                     logger.log("Scan Failed.", type="error")
                 current_url = ""
@@ -267,9 +645,9 @@ class DownloadWorker(Thread):
 
 
 def update_daemon():
-    global download_jobs, global_running_flag, has_new_download, busy_flag
+    global download_jobs, global_running_flag, has_new_download
     try:
-        users_to_watch = [u for u in backend.all_users if not u.flagged][::-1]
+        users_to_watch = [u for u in backend.user_index.all() if not u.flagged][::-1]
         for user in users_to_watch:
             if user.type == "x":
                 url = f"https://x.com/{user.user_name}"
@@ -293,6 +671,12 @@ url_pattern = re.compile(
 )
 
 
+# bump when the output of embed_hyperlink() changes, stored HTML rendered by
+# an older version (or for another url_base) is re-rendered in the background
+RENDER_VERSION = 1
+render_version = f"{RENDER_VERSION}:{config.url_base}"
+
+
 def embed_hyperlink(type, text_content):
     if not text_content:
         return ""
@@ -382,6 +766,30 @@ def embed_hyperlink(type, text_content):
     return text_content
 
 
+# "2024-01-31 12:00:00" from gallery-dl and fadl, "2024-01-31 12:00" from reddit
+time_pattern = re.compile(
+    r"(\d{4})-(\d{1,2})-(\d{1,2})[ T](\d{1,2}):(\d{1,2})(?::(\d{1,2}))?"
+)
+
+
+def parse_time(time_str):
+    """
+    Convert the time strings stored with posts and media to epoch seconds,
+    used for the ts column. Returns 0 if the string can't be parsed.
+    """
+    if not time_str:
+        return 0
+    match = time_pattern.match(str(time_str).strip())
+    if not match:
+        return 0
+    try:
+        return calendar.timegm(
+            tuple(int(x) if x else 0 for x in match.groups()) + (0, 0, 0)
+        )
+    except (ValueError, OverflowError):
+        return 0
+
+
 def list_and(list1, list2):
     # Convert both lists to sets for efficient intersection
     set1 = set(list1)